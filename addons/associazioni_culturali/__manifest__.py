@@ -25,6 +25,9 @@
             "https://cdn.jsdelivr.net/npm/select2@4.0.13/dist/css/select2.min.css",
             "https://cdn.jsdelivr.net/npm/select2@4.0.13/dist/js/select2.full.min.js",
         ],
+        "web.assets_backend": [
+            "associazioni_culturali/static/src/js/tessera_import_progressbar.js",
+        ],
     },
     "data": [
         "security/security.xml",
@@ -32,12 +35,14 @@
         "security/ir_rule.xml",
         "data/email_templates.xml",
         "data/cron_data.xml",
-        "data/res.comune.csv",
+        "data/res_comune_data.xml",
         "data/website_menu.xml",
         "views/associazioni_culturali_views.xml",
         "views/piano_tesseramento_views.xml",
         "views/tessera_views.xml",
         "views/res_comune_views.xml",
+        "views/tessera_import_job_views.xml",
+        "report/tessera_statistiche_views.xml",
         "wizard/tessera_import_wizard_views.xml",
         "views/tesseramento_website_templates.xml",
     ],
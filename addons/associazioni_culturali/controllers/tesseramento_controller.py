@@ -2,12 +2,16 @@
 
 import json
 import logging
-from types import SimpleNamespace
 
-from odoo import _, http
+from psycopg2 import IntegrityError
+
+from odoo import _, fields, http
 from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
 
+from ..models.associato import _cf_canonical, normalize_email
+from ..models.tesseramento_pending import TESSERAMENTO_REFERENCE_PREFIX
+
 _logger = logging.getLogger(__name__)
 
 
@@ -24,26 +28,7 @@ def _post_getlist(data, key):
 
 def _mailing_lists_safe(env):
     """Restituisce liste mailing come oggetti con id, name e description (description vuoto se il modello non ce l'ha)."""
-    if "mailing.list" not in env:
-        return []
-    records = (
-        env["mailing.list"]
-        .sudo()
-        .search(
-            [
-                ("active", "=", True),
-                ("is_public", "=", True),
-            ]
-        )
-    )
-    return [
-        SimpleNamespace(
-            id=m.id,
-            name=m.name,
-            description=getattr(m, "description", None) or "",
-        )
-        for m in records
-    ]
+    return env["associazione.culturale"]._get_public_mailing_lists()
 
 
 class TesseramentoController(http.Controller):
@@ -55,34 +40,92 @@ class TesseramentoController(http.Controller):
         website=True,
     )
     def tesseramento_comuni_search(self, term="", **kw):
-        """Cerca comuni per autocomplete (ritorna JSON per Select2)"""
+        """
+        Cerca comuni per autocomplete (ritorna JSON per Select2). Usato come fallback
+        quando lo snapshot statico dei comuni non è disponibile nel browser.
+        """
         term = (term or kw.get("q") or "").strip()
-        if len(term) >= 1:
-            domain = [
-                "|",
-                ("name", "ilike", term),
-                ("codice_catastale", "ilike", term),
-            ]
-            comuni = (
-                request.env["res.comune"]
-                .sudo()
-                .search(domain, order="name", limit=30)
+        # Risposta dall'indice in memoria del worker: nessuna query per tasto premuto
+        results = request.env["res.comune"].sudo()._search_comuni_index(term, limit=30)
+        return request.make_response(
+            json.dumps({"results": results}),
+            headers=[("Content-Type", "application/json")],
+        )
+
+    @http.route(
+        "/tesseramento/comuni/<string:version>.json",
+        type="http",
+        auth="public",
+        methods=["GET"],
+        sitemap=False,
+        save_session=False,
+    )
+    def tesseramento_comuni_snapshot(self, version, **kw):
+        """
+        Snapshot versionato dei comuni per l'autocomplete lato client. L'URL contiene l'hash
+        del contenuto, quindi la risposta è immutabile e cacheabile da browser e reverse proxy.
+        """
+        current, payload, compressed = request.env["res.comune"].sudo()._get_comuni_snapshot()
+        if version != current:
+            # Versione superata (comuni modificati): rimanda allo snapshot corrente
+            return request.redirect(
+                request.env["res.comune"].sudo()._get_comuni_snapshot_url()
             )
-        else:
-            comuni = (
-                request.env["res.comune"]
+        # Corpo gzip e corpo non compresso sono rappresentazioni diverse: ETag distinti
+        httprequest = request.httprequest
+        gzip = httprequest.accept_encodings["gzip"] > 0
+        tag = f"{current}-gz" if gzip else current
+        headers = [
+            ("Cache-Control", "public, max-age=31536000, immutable"),
+            ("ETag", f'"{tag}"'),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if httprequest.if_none_match.contains_weak(tag):
+            return request.make_response(b"", headers=headers, status=304)
+        headers.append(("Content-Type", "application/json; charset=utf-8"))
+        if gzip:
+            headers.append(("Content-Encoding", "gzip"))
+            payload = compressed
+        return request.make_response(payload, headers=headers)
+
+    @http.route(
+        "/tesseramento/codice_fiscale/calcola",
+        type="http",
+        auth="public",
+        methods=["GET"],
+        website=True,
+    )
+    def tesseramento_codice_fiscale_calcola(self, **kw):
+        """
+        Calcola il codice fiscale atteso dai dati anagrafici (JSON), per precompilare e verificare
+        il CF nel form senza passare dal submit. Se viene passato ``codice_fiscale`` indica anche
+        se corrisponde (in forma canonica) a uno dei codici attesi.
+        """
+        comune_id = kw.get("comune_nascita_id")
+        try:
+            comune_id = int(comune_id) if comune_id else False
+            data_nascita = fields.Date.to_date(kw.get("data_nascita") or False)
+        except ValueError:
+            comune_id = data_nascita = False
+        codici = {}
+        if comune_id and data_nascita:
+            codici = (
+                request.env["associato"]
                 .sudo()
-                .search([], order="name", limit=30)
+                ._calcola_codice_fiscale(
+                    kw.get("nome_legale") or "",
+                    kw.get("cognome_legale") or "",
+                    data_nascita,
+                    comune_id,
+                    sesso=kw.get("sesso"),
+                )
             )
-        results = [
-            {
-                "id": c.id,
-                "text": f"{c.name} ({c.provincia})" if c.provincia else c.name,
-            }
-            for c in comuni
-        ]
+        result = {"codici_fiscali": codici}
+        codice_fiscale = _cf_canonical(kw.get("codice_fiscale") or "")
+        if codici and codice_fiscale:
+            result["corrisponde"] = codice_fiscale in codici.values()
         return request.make_response(
-            json.dumps({"results": results}),
+            json.dumps(result),
             headers=[("Content-Type", "application/json")],
         )
 
@@ -90,34 +133,31 @@ class TesseramentoController(http.Controller):
         "/tesseramento", type="http", auth="public", website=True, methods=["GET"]
     )
     def tesseramento_form(self, **kw):
-        """Mostra il form di tesseramento"""
+        """
+        Mostra il form di tesseramento. Le opzioni (associazioni, piani, liste mailing) sono in
+        cache per sito e lingua, così il render non interroga il database a ogni visita.
+        La pagina non è condivisibile tra visitatori: il layout del sito contiene il token
+        CSRF e dati legati alla sessione.
+        """
         # Verifica se l'utente è loggato (non guest)
         user = request.env.user
         is_logged_in = (
             user and not user._is_public() and user.id != request.website.user_id.id
         )
 
-        # Ottieni associazioni attive che consentono registrazione pubblica
-        associazioni = (
-            request.env["associazione.culturale"]
-            .sudo()
-            .search(
-                [("attivo", "=", True), ("consenti_registrazione_pubblica", "=", True)]
-            )
+        options = request.env["associazione.culturale"].sudo()._get_tesseramento_form_options(
+            request.website.id, request.env.lang
         )
 
-        # Ottieni piani di tesseramento attivi
-        piani = request.env["piano.tesseramento"].sudo().search([("attivo", "=", True)])
-
-        # Liste mailing con solo id/name (compatibile con versioni senza campo description)
-        mailing_lists = _mailing_lists_safe(request.env)
-
         values = {
-            "associazioni": associazioni,
-            "piani": piani,
+            "associazioni": options["associazioni"],
+            "piani": options["piani"],
             "is_logged_in": is_logged_in,
             "user": user if is_logged_in else None,
-            "mailing_lists": mailing_lists,
+            "mailing_lists": options["mailing_lists"],
+            "comuni_snapshot_url": request.env["res.comune"]
+            .sudo()
+            ._get_comuni_snapshot_url(),
         }
 
         return request.render("associazioni_culturali.tesseramento_form", values)
@@ -221,7 +261,7 @@ class TesseramentoController(http.Controller):
                 )
 
             # Trova o crea l'associato con l'email dell'utente e collegalo (reclama)
-            user_email = (user.partner_id.email or user.login or "").strip().lower()
+            user_email = normalize_email(user.partner_id.email or user.login)
             if not user_email:
                 return request.render(
                     "associazioni_culturali.tesseramento_error",
@@ -232,7 +272,7 @@ class TesseramentoController(http.Controller):
                     },
                 )
             Associato = request.env["associato"].sudo()
-            associato = Associato.search([("email", "=", user_email)], limit=1)
+            associato = Associato.search([("email_normalized", "=", user_email)], limit=1)
             # Precompila nome/cognome da account se non inviati
             if (
                 not nome_legale
@@ -285,10 +325,12 @@ class TesseramentoController(http.Controller):
                 "phone": telefono or (associato.phone if associato else False),
             }
             try:
-                if associato:
-                    associato.write(associato_vals)
-                else:
-                    associato = Associato.create(associato_vals)
+                # Savepoint: un associato rifiutato (CF duplicato) non resta nella transazione
+                with request.env.cr.savepoint():
+                    if associato:
+                        associato.write(associato_vals)
+                    else:
+                        associato = Associato.create(associato_vals)
             except ValidationError as e:
                 return request.render(
                     "associazioni_culturali.tesseramento_error",
@@ -296,6 +338,13 @@ class TesseramentoController(http.Controller):
                         "error": str(e),
                     },
                 )
+            except IntegrityError:
+                return request.render(
+                    "associazioni_culturali.tesseramento_error",
+                    {
+                        "error": _("Esiste già un associato con questo codice fiscale."),
+                    },
+                )
 
             # Aggiorna anche il partner per indirizzo/telefono
             if user.partner_id:
@@ -399,27 +448,8 @@ class TesseramentoController(http.Controller):
             )
 
             # Crea una transazione di pagamento
-            # Ottieni il provider di pagamento attivo che supporta la valuta del piano
-            providers = (
-                request.env["payment.provider"]
-                .sudo()
-                .search(
-                    [
-                        ("state", "=", "enabled"),
-                        ("is_published", "=", True),
-                    ]
-                )
-            )
-
-            # Filtra provider che supportano la valuta del piano
-            provider = None
-            for p in providers:
-                if (
-                    not p.available_currency_ids
-                    or piano.currency_id.id in p.available_currency_ids.ids
-                ):
-                    provider = p
-                    break
+            # Provider preferito del piano o, in cache per valuta, il primo provider attivo
+            provider = piano._get_payment_provider(request.env.company)
 
             if not provider:
                 # Se nessun provider disponibile, mostra messaggio più chiaro
@@ -434,7 +464,7 @@ class TesseramentoController(http.Controller):
                 )
 
             # Crea la transazione
-            reference = f"TESS-{tesseramento_pending.id}"
+            reference = f"{TESSERAMENTO_REFERENCE_PREFIX}{tesseramento_pending.id}"
             tx_values = {
                 "amount": piano.costo_tessera,
                 "currency_id": piano.currency_id.id,
@@ -589,9 +619,9 @@ class TesseramentoController(http.Controller):
         )
 
         if tx.state == "done" and tesseramento:
-            # Completa il tesseramento se non già fatto
-            if tesseramento.stato == "paid" and not tesseramento.tessera_id:
-                tessera = tesseramento.action_completa_tessera()
+            # Completa il tesseramento se non già fatto; se il webhook lo sta completando
+            # in parallelo (o lo ha già completato) il pending viene saltato
+            tesseramento._completa_pagamento()
 
             # Reindirizza alla pagina di successo
             return request.redirect("/tesseramento/success")
@@ -618,7 +648,6 @@ class TesseramentoController(http.Controller):
         tessera_attuale_id = False
         tessera_in_scadenza = False
         for ass in associati:
-            ass._compute_tessera_attuale()
             tessere_passate |= ass.get_tessere_passate()
             if ass.tessera_attuale_id and not tessera_attuale_id:
                 tessera_attuale_id = ass.tessera_attuale_id
@@ -649,7 +678,7 @@ class TesseramentoController(http.Controller):
         user = request.env.user
         if user._is_public():
             return request.redirect("/web/login?redirect=/my/associato/reclama")
-        user_email = (user.partner_id.email or user.login or "").strip().lower()
+        user_email = normalize_email(user.partner_id.email or user.login)
         if not user_email:
             return request.render(
                 "associazioni_culturali.associato_reclama",
@@ -665,7 +694,7 @@ class TesseramentoController(http.Controller):
             .sudo()
             .search(
                 [
-                    ("email", "=", user_email),
+                    ("email_normalized", "=", user_email),
                     ("user_id", "=", False),
                 ]
             )
@@ -765,6 +794,9 @@ class TesseramentoController(http.Controller):
             "countries": countries,
             "associazione_id": int(associazione_id) if associazione_id else None,
             "piano_id": int(piano_id) if piano_id else None,
+            "comuni_snapshot_url": request.env["res.comune"]
+            .sudo()
+            ._get_comuni_snapshot_url(),
         }
         return request.render("associazioni_culturali.rinnova_tessera_form", values)
 
@@ -894,7 +926,8 @@ class TesseramentoController(http.Controller):
                 associato_vals["phone"] = telefono
             if associato_vals:
                 try:
-                    associato.sudo().write(associato_vals)
+                    with request.env.cr.savepoint():
+                        associato.sudo().write(associato_vals)
                 except ValidationError as e:
                     return request.render(
                         "associazioni_culturali.tesseramento_error",
@@ -902,6 +935,13 @@ class TesseramentoController(http.Controller):
                             "error": str(e),
                         },
                     )
+                except IntegrityError:
+                    return request.render(
+                        "associazioni_culturali.tesseramento_error",
+                        {
+                            "error": _("Esiste già un associato con questo codice fiscale."),
+                        },
+                    )
 
             if user.partner_id:
                 partner_vals = {}
@@ -990,25 +1030,7 @@ class TesseramentoController(http.Controller):
             )
 
             # Crea transazione pagamento
-            providers = (
-                request.env["payment.provider"]
-                .sudo()
-                .search(
-                    [
-                        ("state", "=", "enabled"),
-                        ("is_published", "=", True),
-                    ]
-                )
-            )
-
-            provider = None
-            for p in providers:
-                if (
-                    not p.available_currency_ids
-                    or piano.currency_id.id in p.available_currency_ids.ids
-                ):
-                    provider = p
-                    break
+            provider = piano._get_payment_provider(request.env.company)
 
             if not provider:
                 return request.render(
@@ -1020,7 +1042,7 @@ class TesseramentoController(http.Controller):
                     },
                 )
 
-            reference = f"TESS-RINN-{tesseramento_pending.id}"
+            reference = f"{TESSERAMENTO_REFERENCE_PREFIX}RINN-{tesseramento_pending.id}"
             tx = (
                 request.env["payment.transaction"]
                 .sudo()
@@ -1,8 +1,13 @@
+import argparse
 import csv
 import os
 import sys
 
-# Script per convertire il CSV ISTAT dei comuni nel formato XML/CSV importabile in Odoo
+# Script per aggiornare res.comune.csv a partire dal CSV ISTAT dei comuni.
+# Confronta l'export ISTAT con il dataset corrente (chiave: codice catastale) e applica
+# solo le differenze: comuni nuovi, rinominati/modificati e soppressi.
+# I comuni soppressi restano nel dataset con active=0, così i codici catastali storici
+# (presenti nei codici fiscali delle persone nate prima della soppressione) restano risolvibili.
 # Fonte dati attesa: Elenco-comuni-italiani.csv (formato ISTAT standard)
 # Encoding input: ISO-8859-1 (Latin1) o Windows-1252
 
@@ -10,91 +15,151 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 INPUT_FILE = os.path.join(BASE_DIR, "Elenco-comuni-italiani.csv")
 OUTPUT_FILE = os.path.join(BASE_DIR, "res.comune.csv")
 
-
-def main():
-    print(f"Reading {INPUT_FILE}...")
-
+FIELDS = ["id", "name", "codice_catastale", "provincia", "codice_istat", "cap", "active"]
+# Campi confrontati con l'export ISTAT (il CAP non è presente nel file ISTAT standard)
+ISTAT_FIELDS = ("name", "provincia", "codice_istat")
+ESTERO = {
+    "id": "comune_estero",
+    "name": "Estero",
+    "codice_catastale": "Z000",
+    "provincia": "",
+    "codice_istat": "",
+    "cap": "",
+    "active": "1",
+}
+
+
+def read_dataset(path):
+    """Dataset corrente indicizzato per codice catastale, nell'ordine del file."""
+    dataset = {}
+    if not os.path.exists(path):
+        return dataset
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            # Dataset precedenti senza colonna active: tutti i comuni sono attivi
+            row["active"] = "0" if row.get("active") in ("0", "False", "false") else "1"
+            dataset[row["codice_catastale"]] = {k: row.get(k) or "" for k in FIELDS}
+    return dataset
+
+
+def iter_istat(path):
+    """Righe dell'export ISTAT come dict nel formato del dataset, lette in streaming."""
+    # Usa encoding 'latin1' che è tollerante per i file ISTAT
+    with open(path, "r", encoding="latin1", newline="") as f:
+        reader = csv.reader(f, delimiter=";")
+        # Salta intestazione ISTAT
+        next(reader, None)
+        for row in reader:
+            # Salta righe vuote o malformate
+            if not row or len(row) < 20:
+                continue
+            # Colonne ISTAT standard:
+            # 4: Codice Comune formato alfanumerico
+            # 5: Denominazione (Italiana e straniera)
+            # 6: Denominazione in italiano
+            # 14: Sigla automobilistica
+            # 19: Codice Catastale del comune
+            nome = row[6].strip() or row[5].strip()
+            codice_catastale = row[19].strip()
+            # Senza codice catastale il comune non è identificabile
+            if not codice_catastale:
+                print(f"Skipping row without codice catastale: {row[:7]}", file=sys.stderr)
+                continue
+            yield {
+                "id": f"comune_{codice_catastale}",
+                "name": nome,
+                "codice_catastale": codice_catastale,
+                "provincia": row[14].strip(),
+                "codice_istat": row[4].strip(),
+                "cap": "",
+                "active": "1",
+            }
+
+
+def diff(dataset, istat_rows):
+    """
+    Applica l'export ISTAT al dataset. Restituisce (dataset aggiornato, aggiunti,
+    modificati, soppressi); modificati è una lista di (vecchio, nuovo).
+    """
+    result = dict(dataset)
+    result.setdefault(ESTERO["codice_catastale"], dict(ESTERO))
+    added, changed, suppressed = [], [], []
+    seen = {ESTERO["codice_catastale"]}
+    for new in istat_rows:
+        code = new["codice_catastale"]
+        seen.add(code)
+        old = result.get(code)
+        if old is None:
+            result[code] = new
+            added.append(new)
+            continue
+        if old["active"] != "1" or any(old[k] != new[k] for k in ISTAT_FIELDS):
+            updated = dict(old, active="1", **{k: new[k] for k in ISTAT_FIELDS})
+            result[code] = updated
+            changed.append((old, updated))
+    for code, old in dataset.items():
+        if code not in seen and old["active"] == "1":
+            result[code] = dict(old, active="0")
+            suppressed.append(old)
+    return result, added, changed, suppressed
+
+
+def write_dataset(path, dataset):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f_out:
+        writer = csv.writer(f_out, quoting=csv.QUOTE_ALL)
+        writer.writerow(FIELDS)
+        for row in dataset.values():
+            writer.writerow([row[k] for k in FIELDS])
+    os.replace(tmp_path, path)
+
+
+def label(row):
+    return f"{row['codice_catastale']} {row['name']} ({row['provincia'] or '-'})"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__ or "Aggiorna res.comune.csv dall'export ISTAT")
+    parser.add_argument("--istat", default=INPUT_FILE, help="Export ISTAT (CSV ';', latin1)")
+    parser.add_argument("--dataset", default=OUTPUT_FILE, help="Dataset res.comune.csv da aggiornare")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Mostra solo le differenze senza scrivere"
+    )
+    args = parser.parse_args(argv)
+
+    print(f"Reading {args.dataset} and {args.istat}...")
     try:
-        # Usa encoding 'latin1' che è tollerante per i file ISTAT
-        with (
-            open(INPUT_FILE, "r", encoding="latin1", newline="") as f_in,
-            open(OUTPUT_FILE, "w", encoding="utf-8", newline="") as f_out,
-        ):
-            reader = csv.reader(f_in, delimiter=";")
-            writer = csv.writer(f_out, quoting=csv.QUOTE_NONNUMERIC)
-
-            # Scrivi header Odoo
-            # Campi: id (xml_id), name, codice_catastale, provincia, codice_istat, cap
-            writer.writerow(
-                ["id", "name", "codice_catastale", "provincia", "codice_istat", "cap"]
-            )
-
-            # Aggiungi record speciale per Estero
-            writer.writerow(["comune_estero", "Estero", "Z000", "", "", ""])
-
-            # Salta intestazione ISTAT
-            try:
-                header = next(reader)
-            except StopIteration:
-                print("Error: Empty input file")
-                return
-
-            count = 0
-            for row in reader:
-                # Salta righe vuote o malformate
-                if not row or len(row) < 19:
-                    continue
-
-                try:
-                    # Estrazione dati basata su colonne ISTAT standard
-                    # 4: Codice Comune formato alfanumerico
-                    # 5: Denominazione (Italiana e straniera)
-                    # 6: Denominazione in italiano
-                    # 14: Sigla automobilistica
-                    # 19: Codice Catastale del comune
-
-                    # Nome: usa denominazione italiano (6) se presente, altrimenti (5)
-                    # Nota: alcuni file ISTAT hanno denominazione in colonna 5 e basta.
-                    # Controlliamo se colonna 6 esiste ed è piena.
-                    nome = row[5].strip()
-                    if len(row) > 6 and row[6].strip():
-                        nome = row[6].strip()
-
-                    provincia = row[14].strip() if len(row) > 14 else ""
-                    codice_istat = row[4].strip() if len(row) > 4 else ""
-                    codice_catastale = row[19].strip() if len(row) > 19 else ""
-
-                    # Se manca il codice catastale, salta (essenziale per ID e logica)
-                    if not codice_catastale:
-                        continue
-
-                    # Genera ID univoco (External ID)
-                    xml_id = f"comune_{codice_catastale}"
-
-                    # Scrivi riga
-                    writer.writerow(
-                        [
-                            xml_id,
-                            nome,
-                            codice_catastale,
-                            provincia,
-                            codice_istat,
-                            "",  # CAP non disponibile nel file ISTAT standard
-                        ]
-                    )
-                    count += 1
-
-                except Exception as e:
-                    print(f"Skipping row due to error: {e} - Row: {row}")
-                    continue
-
-            print(f"Successfully converted {count} municipalities to {OUTPUT_FILE}.")
-
-    except FileNotFoundError:
-        print(f"Error: File {INPUT_FILE} not found.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        dataset = read_dataset(args.dataset)
+        had_active = _has_active_column(args.dataset)
+        result, added, changed, suppressed = diff(dataset, iter_istat(args.istat))
+    except FileNotFoundError as e:
+        print(f"Error: File {e.filename} not found.")
+        return 1
+
+    for row in added:
+        print(f"+ {label(row)}")
+    for old, new in changed:
+        print(f"~ {label(old)} -> {label(new)}")
+    for row in suppressed:
+        print(f"- {label(row)} (archiviato)")
+    print(f"{len(added)} added, {len(changed)} changed, {len(suppressed)} suppressed.")
+
+    if args.dry_run:
+        return 0
+    if not (added or changed or suppressed) and had_active and len(result) == len(dataset):
+        print(f"{args.dataset} is already up to date.")
+        return 0
+    write_dataset(args.dataset, result)
+    print(f"Successfully wrote {len(result)} municipalities to {args.dataset}.")
+    return 0
+
+
+def _has_active_column(path):
+    if not os.path.exists(path):
+        return False
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return "active" in (next(csv.reader(f), None) or [])
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
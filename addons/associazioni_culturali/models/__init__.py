@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from . import (
+    cache_mixin,
     associato,
     associazione_culturale,
+    mailing_list,
+    payment_provider,
     payment_transaction,
     piano_tesseramento,
     res_comune,
     res_users,
     tessera,
+    tessera_import_job,
     tesseramento_pending,
 )
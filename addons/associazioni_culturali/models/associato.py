@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import re
 from datetime import date
 
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError, ValidationError
 
+_logger = logging.getLogger(__name__)
+
+# Giorni prima della scadenza da cui la tessera attuale è considerata "in scadenza"
+SCADENZA_GIORNI = 30
+
 # Tabelle per il carattere di controllo del codice fiscale italiano
 # Secondo l'algoritmo ufficiale: https://www.alus.it/pubs/CodiceFiscale/index.php?lang=it
 # Valori per caratteri in posizione DISPARI (1, 3, 5, 7, 9, 11, 13, 15)
@@ -149,6 +155,29 @@ _CF_ACCENT_MAP = {
 }
 _CF_VOWELS = set("AEIOU")
 
+# Formato del codice fiscale (16 caratteri, con eventuale omocodia), compilato una sola volta
+_CF_FORMAT_RE = re.compile(
+    r"^[A-Z]{6}[0-9LMNPQRSTUV]{2}[ABCDEHLMPRST][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$"
+)
+
+
+def _cf_flat_table(values):
+    """Converte una tabella carattere -> valore in una lista indicizzata per ord(carattere)."""
+    table = [0] * 128
+    for char, value in values.items():
+        table[ord(char)] = value
+    return table
+
+
+# Tabelle piatte per il carattere di controllo: evitano lookup su dict nel ciclo di validazione
+_CF_ODD_TABLE = _cf_flat_table(_CF_ODD)
+_CF_EVEN_TABLE = _cf_flat_table(_CF_EVEN)
+
+# Omocodia: nelle posizioni numeriche (7, 8, 10, 11, 13, 14, 15) le cifre possono essere
+# sostituite dalle lettere LMNPQRSTUV (L=0 ... V=9) per distinguere codici altrimenti uguali
+_CF_OMOCODIA_POSITIONS = (6, 7, 9, 10, 12, 13, 14)
+_CF_OMOCODIA_TRANS = str.maketrans("LMNPQRSTUV", "0123456789")
+
 
 def _normalize_cf_string(s):
     """Normalizza una stringa per il confronto con le parti nome/cognome del CF: maiuscolo, solo A-Z."""
@@ -203,6 +232,201 @@ def _cf_letters_from_name(name):
     return "".join(result)
 
 
+def _clean_codice_fiscale(cf):
+    """Pulisce il codice fiscale: maiuscolo, solo caratteri alfanumerici."""
+    if not cf:
+        return ""
+    return "".join(c for c in str(cf).upper() if c.isalnum())
+
+
+def _cf_control_char(cf):
+    """Carattere di controllo calcolato sui primi 15 caratteri (già in formato valido)."""
+    total = sum(_CF_ODD_TABLE[ord(c)] for c in cf[0:15:2]) + sum(
+        _CF_EVEN_TABLE[ord(c)] for c in cf[1:15:2]
+    )
+    return _CF_CONTROL[total % 26]
+
+
+def _cf_deomocodia(cf):
+    """Ripristina le cifre originali nelle posizioni numeriche sostituite per omocodia."""
+    chars = list(cf)
+    for pos in _CF_OMOCODIA_POSITIONS:
+        if pos < len(chars):
+            chars[pos] = chars[pos].translate(_CF_OMOCODIA_TRANS)
+    return "".join(chars)
+
+
+def _cf_canonical(cf):
+    """
+    Forma canonica del codice fiscale, usata per le ricerche e per l'univocità:
+    codice pulito, omocodia rimossa e carattere di controllo ricalcolato.
+    I codici non in formato valido vengono restituiti solo puliti.
+    """
+    cf = _clean_codice_fiscale(cf)
+    if len(cf) != 16 or not _CF_FORMAT_RE.match(cf):
+        return cf
+    base = _cf_deomocodia(cf[:15])
+    return base + _cf_control_char(base)
+
+
+# Lettera del mese per la generazione del codice fiscale (inversa di _CF_MONTH)
+_CF_MONTH_LETTER = {month: letter for letter, month in _CF_MONTH.items()}
+
+
+def _cf_compute(nome, cognome, data_nascita, sesso, codice_catastale):
+    """
+    Genera il codice fiscale atteso (senza omocodia) da nome, cognome, data di nascita,
+    sesso ("M"/"F") e codice catastale del comune di nascita. Restituisce "" se i dati non bastano.
+    """
+    surname = _cf_letters_from_surname(cognome)
+    name = _cf_letters_from_name(nome)
+    data_nascita = fields.Date.to_date(data_nascita)
+    if not (surname and name and data_nascita and codice_catastale):
+        return ""
+    day = data_nascita.day + (40 if sesso == "F" else 0)
+    cf15 = "%s%s%02d%s%02d%s" % (
+        surname,
+        name,
+        data_nascita.year % 100,
+        _CF_MONTH_LETTER[data_nascita.month],
+        day,
+        codice_catastale.upper(),
+    )
+    return cf15 + _cf_control_char(cf15)
+
+
+def _cf_birth_date(cf):
+    """Estrae la data di nascita dal codice fiscale (16 caratteri, maiuscolo), anche omocodico."""
+    cf = _cf_deomocodia(cf.upper().strip())
+    if len(cf) < 11:
+        raise ValueError(_("Codice fiscale troppo corto"))
+    # Anno: pos 7-8. Due cifre: 00-29 -> 2000-2029, 30-99 -> 1930-1999
+    if cf[6].isdigit() and cf[7].isdigit():
+        yy = int(cf[6]) * 10 + int(cf[7])
+        year = 2000 + yy if yy <= 29 else 1900 + yy
+    else:
+        raise ValueError(_("Anno non valido nel CF"))
+    month = _CF_MONTH.get(cf[8])
+    if not month:
+        raise ValueError(_("Mese non valido nel CF"))
+    if not (cf[9].isdigit() and cf[10].isdigit()):
+        raise ValueError(_("Giorno non valido nel CF"))
+    day = int(cf[9]) * 10 + int(cf[10])
+    if day > 40:
+        day -= 40  # donne: 41-71 -> 1-31
+    if day < 1 or day > 31:
+        raise ValueError(_("Giorno non valido nel CF"))
+    return date(year, month, day)
+
+
+def _cf_validation_error(vals, comune=None):
+    """
+    Restituisce il messaggio di errore per i valori di un associato, oppure False se il CF è valido.
+    ``comune`` è la coppia (nome, codice catastale) del comune di nascita, già letta dal chiamante.
+    """
+    # Se ha segnato "non ho codice fiscale", il CF non è obbligatorio e non si valida
+    if vals.get("no_codice_fiscale"):
+        return False
+    cf = _clean_codice_fiscale(vals.get("codice_fiscale"))
+    # Se non ha segnato "non ho codice fiscale" ma il CF è vuoto -> errore
+    if not cf:
+        return _(
+            'Il codice fiscale è obbligatorio. Se non sei residente in Italia, spunta "Non ho residenza italiana / codice fiscale".'
+        )
+    if len(cf) != 16:
+        return _("Il codice fiscale deve essere esattamente di 16 caratteri.")
+    if not _CF_FORMAT_RE.match(cf):
+        return _(
+            "Il codice fiscale non è valido: formato non corretto. "
+            "Verifica i 16 caratteri (lettere e numeri secondo lo standard italiano)."
+        )
+    if cf[15] != _cf_control_char(cf):
+        return _("Il codice fiscale non è valido: carattere di controllo errato.")
+    # Coerenza con data di nascita se presente
+    data_nascita = fields.Date.to_date(vals.get("data_nascita"))
+    if data_nascita:
+        try:
+            cf_date = _cf_birth_date(cf)
+        except (ValueError, KeyError) as e:
+            return _(
+                "Impossibile verificare la data di nascita nel codice fiscale: %s"
+            ) % str(e)
+        if cf_date != data_nascita:
+            return _(
+                "Il codice fiscale non è coerente con la data di nascita indicata. "
+                "Data nel CF: %s; data indicata: %s."
+            ) % (cf_date.strftime("%d/%m/%Y"), data_nascita.strftime("%d/%m/%Y"))
+    # Match con cognome legale (pos. 1-3 del CF)
+    cognome = (vals.get("cognome_legale") or "").strip()
+    if cognome:
+        expected_surname = _cf_letters_from_surname(cognome)
+        if expected_surname and cf[0:3] != expected_surname:
+            return _(
+                "Il codice fiscale non è coerente con il cognome indicato: "
+                'le prime tre lettere del CF (%s) non corrispondono al cognome "%s".'
+            ) % (cf[0:3], cognome)
+    # Match con nome legale (pos. 4-6 del CF)
+    nome = (vals.get("nome_legale") or "").strip()
+    if nome:
+        expected_name = _cf_letters_from_name(nome)
+        if expected_name and cf[3:6] != expected_name:
+            return _(
+                "Il codice fiscale non è coerente con il nome indicato: "
+                'le lettere del nome nel CF (%s) non corrispondono al nome "%s".'
+            ) % (cf[3:6], nome)
+    if comune:
+        comune_name, codice_catastale = comune
+        if comune_name == "Estero":
+            if cf[11] != "Z":
+                return _(
+                    "Il codice fiscale non sembra appartenere a una persona nata all'estero (deve contenere la 'Z' nel codice luogo)."
+                )
+        elif codice_catastale:
+            expected_code = codice_catastale.upper()
+            cf_code = _cf_deomocodia(cf)[11:15]
+            if cf_code != expected_code:
+                return _(
+                    "Il codice fiscale non corrisponde al comune di nascita indicato (%s). "
+                    "Codice nel CF: %s. Codice atteso: %s."
+                ) % (comune_name, cf_code, expected_code)
+    return False
+
+
+def validate_codici_fiscali(env, entries):
+    """
+    Valida in blocco i codici fiscali.
+
+    ``entries`` è un iterabile di coppie (chiave, valori), dove i valori contengono i campi
+    dell'associato usati dalla validazione: codice_fiscale, no_codice_fiscale, data_nascita,
+    nome_legale, cognome_legale, comune_nascita_id (id intero). I comuni di nascita vengono
+    letti con una sola query per tutto il blocco.
+
+    Restituisce un dizionario {chiave: messaggio di errore} con le sole voci non valide.
+    """
+    entries = list(entries)
+    comune_ids = {vals.get("comune_nascita_id") for key, vals in entries} - {None, False}
+    comuni = {}
+    if comune_ids:
+        comuni = {
+            c["id"]: (c["name"], c["codice_catastale"])
+            for c in env["res.comune"]
+            .sudo()
+            .with_context(active_test=False)
+            .search_read([("id", "in", list(comune_ids))], ["name", "codice_catastale"])
+        }
+    errors = {}
+    for key, vals in entries:
+        error = _cf_validation_error(vals, comuni.get(vals.get("comune_nascita_id")))
+        if error:
+            errors[key] = error
+    return errors
+
+
+def normalize_email(email):
+    """Email senza spazi e in minuscolo: forma usata per confrontare e cercare le email."""
+    return (email or "").strip().lower()
+
+
 class Associato(models.Model):
     _name = "associato"
     _description = _("Associato")
@@ -212,6 +436,15 @@ class Associato(models.Model):
         string="Nome", compute="_compute_name", store=True, readonly=True
     )
     email = fields.Char(string="Email", required=True, index=True)
+    email_normalized = fields.Char(
+        string="Email normalizzata",
+        compute="_compute_email_normalized",
+        store=True,
+        readonly=True,
+        index=True,
+        copy=False,
+        help="Email senza spazi e in minuscolo, usata per tutte le ricerche case-insensitive.",
+    )
     nome_legale = fields.Char(string="Nome legale")
     cognome_legale = fields.Char(string="Cognome legale")
     nome_elezione = fields.Char(
@@ -225,6 +458,14 @@ class Associato(models.Model):
         help="Utente che ha reclamato questo profilo (stessa email). Vuoto se non ancora associato.",
     )
     codice_fiscale = fields.Char(string="Codice Fiscale")
+    codice_fiscale_normalizzato = fields.Char(
+        string="Codice Fiscale normalizzato",
+        compute="_compute_codice_fiscale_normalizzato",
+        store=True,
+        readonly=True,
+        copy=False,
+        help="Codice fiscale in forma canonica (omocodia rimossa), usato per ricerche e univocità.",
+    )
     no_codice_fiscale = fields.Boolean(
         string="Non ho residenza italiana / codice fiscale",
         default=False,
@@ -248,17 +489,42 @@ class Associato(models.Model):
     tessere_ids = fields.One2many(
         "tessera", "associato_id", string="Tessere", readonly=True
     )
+    tessere_archiviate_ids = fields.One2many(
+        "tessera",
+        "associato_id",
+        string="Tessere archiviate",
+        readonly=True,
+        domain=[("active", "=", False)],
+        context={"active_test": False},
+    )
 
+    # Tessera attuale memorizzata: ricalcolata dall'ORM quando le tessere del socio vengono
+    # create, annullate o modificate; le transizioni dovute alla data le applica il cron
+    # giornaliero (tessera._cron_aggiorna_stati)
     tessera_attuale_id = fields.Many2one(
         "tessera",
         string="Tessera Attuale",
         compute="_compute_tessera_attuale",
-        store=False,
+        store=True,
+        index="btree_not_null",
+    )
+    tessera_attuale_scadenza = fields.Date(
+        string="Scadenza Tessera Attuale",
+        compute="_compute_tessera_attuale",
+        store=True,
+        index="btree_not_null",
     )
     tessera_in_scadenza = fields.Boolean(
         string="Tessera in Scadenza",
         compute="_compute_tessera_attuale",
-        store=False,
+        store=True,
+    )
+
+    # Indice univoco parziale sul CF canonico: le ricerche per CF diventano index hit e
+    # i duplicati (anche omocodici) vengono rifiutati dal database
+    _codice_fiscale_normalizzato_uniq = models.UniqueIndex(
+        "(codice_fiscale_normalizzato) WHERE codice_fiscale_normalizzato IS NOT NULL",
+        "Esiste già un associato con questo codice fiscale (o equivalente per omocodia).",
     )
 
     @api.depends("email", "nome_elezione", "cognome_legale")
@@ -278,6 +544,78 @@ class Associato(models.Model):
             else:
                 record.name = _("Nuovo Associato")
 
+    @api.depends("email")
+    def _compute_email_normalized(self):
+        for record in self:
+            record.email_normalized = normalize_email(record.email) or False
+
+    def init(self):
+        # L'indice univoco sul CF canonico (_codice_fiscale_normalizzato_uniq) non può
+        # essere creato se esistono già duplicati: l'aggiornamento si interrompe elencandoli,
+        # vanno unificati a mano prima di ripeterlo
+        self.env.cr.execute(
+            "SELECT id, codice_fiscale FROM associato"
+            " WHERE codice_fiscale IS NOT NULL AND no_codice_fiscale IS NOT TRUE"
+        )
+        seen = {}
+        duplicates = []
+        for associato_id, codice_fiscale in self.env.cr.fetchall():
+            cf = _cf_canonical(codice_fiscale)
+            if cf and cf in seen:
+                duplicates.append((seen[cf], associato_id))
+            seen.setdefault(cf, associato_id)
+        if duplicates:
+            raise UserError(
+                _("Associati con codice fiscale equivalente (id): %s. Unificali prima di aggiornare il modulo.")
+                % ", ".join("%s/%s" % pair for pair in duplicates)
+            )
+
+    @api.depends("codice_fiscale", "no_codice_fiscale")
+    def _compute_codice_fiscale_normalizzato(self):
+        for record in self:
+            if record.no_codice_fiscale:
+                record.codice_fiscale_normalizzato = False
+            else:
+                record.codice_fiscale_normalizzato = (
+                    _cf_canonical(record.codice_fiscale) or False
+                )
+
+    @api.constrains("codice_fiscale", "no_codice_fiscale")
+    def _check_codice_fiscale_univoco(self):
+        """Rifiuta associati con codice fiscale equivalente (anche in forma omocodica) a uno esistente."""
+        by_cf = {}
+        for record in self:
+            cf = record.codice_fiscale_normalizzato
+            if not cf:
+                continue
+            if cf in by_cf:
+                raise ValidationError(
+                    _("Il codice fiscale %s è indicato per più associati.") % cf
+                )
+            by_cf[cf] = record.id
+        if not by_cf:
+            return
+        # SQL diretto: evita il flush del campo (che violerebbe l'indice prima del messaggio)
+        self.env.cr.execute(
+            "SELECT codice_fiscale_normalizzato FROM associato"
+            " WHERE codice_fiscale_normalizzato = ANY(%s) AND id != ALL(%s) LIMIT 1",
+            (list(by_cf), self.ids),
+        )
+        row = self.env.cr.fetchone()
+        if row:
+            raise ValidationError(
+                _("Esiste già un associato con codice fiscale %s (o equivalente per omocodia).")
+                % row[0]
+            )
+
+    @api.model
+    def _search_by_codice_fiscale(self, codici_fiscali):
+        """Associati per codice fiscale, confrontati in forma canonica (ricerca sull'indice)."""
+        canonical = {_cf_canonical(cf) for cf in codici_fiscali} - {""}
+        if not canonical:
+            return self.browse()
+        return self.search([("codice_fiscale_normalizzato", "in", list(canonical))])
+
     @api.onchange("codice_fiscale")
     def _onchange_codice_fiscale(self):
         """Pulisce il codice fiscale rimuovendo spazi e caratteri non validi."""
@@ -304,159 +642,90 @@ class Associato(models.Model):
     )
     def _check_codice_fiscale(self):
         """Valida formato, carattere di controllo, coerenza con data di nascita e match con cognome/nome."""
+        errors = self._validate_codici_fiscali()
         for record in self:
-            # Se ha segnato "non ho codice fiscale", il CF non è obbligatorio e non si valida
-            if record.no_codice_fiscale:
-                continue
-            # Se non ha segnato "non ho codice fiscale" ma il CF è vuoto -> errore
-            if not record.codice_fiscale or not record.codice_fiscale.strip():
-                raise ValidationError(
-                    _(
-                        'Il codice fiscale è obbligatorio. Se non sei residente in Italia, spunta "Non ho residenza italiana / codice fiscale".'
-                    )
-                )
-            # Pulizia CF
-            cf = record.codice_fiscale.upper().strip()
-            cf = "".join(c for c in cf if c.isalnum())
-            if len(cf) != 16:
-                raise ValidationError(
-                    _("Il codice fiscale deve essere esattamente di 16 caratteri.")
-                )
-            if not re.match(
-                r"^[A-Z]{6}[0-9LMNPQRSTUV]{2}[ABCDEHLMPRST][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$",
-                cf,
-            ):
-                raise ValidationError(
-                    _(
-                        "Il codice fiscale non è valido: formato non corretto. "
-                        "Verifica i 16 caratteri (lettere e numeri secondo lo standard italiano)."
-                    )
-                )
-            # Carattere di controllo (posizioni 1-15: dispari usano _CF_ODD, pari usano _CF_EVEN)
-            total = 0
-            for i, c in enumerate(cf[:15]):
-                total += _CF_EVEN.get(c, 0) if (i + 1) % 2 == 0 else _CF_ODD.get(c, 0)
-            expected_control = _CF_CONTROL[total % 26]
-            if cf[15] != expected_control:
-                raise ValidationError(
-                    _("Il codice fiscale non è valido: carattere di controllo errato.")
-                )
-            # Coerenza con data di nascita se presente
-            if record.data_nascita:
-                try:
-                    cf_date = self._codice_fiscale_to_birth_date(cf)
-                    if cf_date != record.data_nascita:
-                        raise ValidationError(
-                            _(
-                                "Il codice fiscale non è coerente con la data di nascita indicata. "
-                                "Data nel CF: %s; data indicata: %s."
-                            )
-                            % (
-                                cf_date.strftime("%d/%m/%Y"),
-                                record.data_nascita.strftime("%d/%m/%Y"),
-                            )
-                        )
-                except (ValueError, KeyError) as e:
-                    raise ValidationError(
-                        _(
-                            "Impossibile verificare la data di nascita nel codice fiscale: %s"
-                        )
-                        % str(e)
-                    )
-            # Match con cognome legale (pos. 1-3 del CF)
-            if record.cognome_legale and record.cognome_legale.strip():
-                expected_surname = _cf_letters_from_surname(record.cognome_legale)
-                if expected_surname and cf[0:3] != expected_surname:
-                    raise ValidationError(
-                        _(
-                            "Il codice fiscale non è coerente con il cognome indicato: "
-                            'le prime tre lettere del CF (%s) non corrispondono al cognome "%s".'
-                        )
-                        % (cf[0:3], record.cognome_legale.strip())
-                    )
-            # Match con nome legale (pos. 4-6 del CF)
-            if record.nome_legale and record.nome_legale.strip():
-                expected_name = _cf_letters_from_name(record.nome_legale)
-                if expected_name and cf[3:6] != expected_name:
-                    raise ValidationError(
-                        _(
-                            "Il codice fiscale non è coerente con il nome indicato: "
-                            'le lettere del nome nel CF (%s) non corrispondono al nome "%s".'
-                        )
-                        % (cf[3:6], record.nome_legale.strip())
-                    )
+            if record.id in errors:
+                raise ValidationError(errors[record.id])
+
+    def _cf_validation_values(self):
+        """Valori dell'associato usati dalla validazione del codice fiscale."""
+        self.ensure_one()
+        return {
+            "codice_fiscale": self.codice_fiscale,
+            "no_codice_fiscale": self.no_codice_fiscale,
+            "data_nascita": self.data_nascita,
+            "nome_legale": self.nome_legale,
+            "cognome_legale": self.cognome_legale,
+            "comune_nascita_id": self.comune_nascita_id.id,
+        }
 
-            if record.comune_nascita_id:
-                if record.comune_nascita_id.name == "Estero":
-                    if cf[11] != "Z":
-                        raise ValidationError(
-                            _(
-                                "Il codice fiscale non sembra appartenere a una persona nata all'estero (deve contenere la 'Z' nel codice luogo)."
-                            )
-                        )
-                elif record.comune_nascita_id.codice_catastale:
-                    expected_code = record.comune_nascita_id.codice_catastale.upper()
-                    if cf[11:15] != expected_code:
-                        raise ValidationError(
-                            _(
-                                "Il codice fiscale non corrisponde al comune di nascita indicato (%s). "
-                                "Codice nel CF: %s. Codice atteso: %s."
-                            )
-                            % (
-                                record.comune_nascita_id.name,
-                                cf[11:15],
-                                expected_code,
-                            )
-                        )
+    def _validate_codici_fiscali(self):
+        """Valida in blocco i codici fiscali del recordset: restituisce {id: messaggio di errore}."""
+        return validate_codici_fiscali(
+            self.env, ((record.id, record._cf_validation_values()) for record in self)
+        )
+
+    @api.model
+    def _calcola_codice_fiscale(self, nome, cognome, data_nascita, comune_id, sesso=None):
+        """
+        Codici fiscali attesi per i dati anagrafici, per sesso: {"M": cf, "F": cf}
+        (solo il sesso indicato, se passato). Vuoto se i dati non bastano o il comune è "Estero".
+        """
+        comune = self.env["res.comune"]._get_comune_cf_data(comune_id) if comune_id else None
+        if not comune or comune[0] == "Estero":
+            return {}
+        result = {}
+        for code in (sesso,) if sesso in ("M", "F") else ("M", "F"):
+            cf = _cf_compute(nome, cognome, data_nascita, code, comune[1])
+            if cf:
+                result[code] = cf
+        return result
 
     @api.model
     def _codice_fiscale_to_birth_date(self, cf):
         """Estrae la data di nascita dal codice fiscale (16 caratteri, maiuscolo)."""
-        cf = cf.upper().strip()
-        if len(cf) < 11:
-            raise ValueError(_("Codice fiscale troppo corto"))
-        # Anno: pos 7-8. Due cifre: 00-29 -> 2000-2029, 30-99 -> 1930-1999; lettera L-V + cifra -> 2000-2009
-        if cf[6].isdigit() and cf[7].isdigit():
-            yy = int(cf[6]) * 10 + int(cf[7])
-            year = 2000 + yy if yy <= 29 else 1900 + yy
-        elif cf[6] in "LMNPQRSTUV" and cf[7].isdigit():
-            year = 2000 + int(cf[7])
-        else:
-            raise ValueError(_("Anno non valido nel CF"))
-        month = _CF_MONTH.get(cf[8])
-        if not month:
-            raise ValueError(_("Mese non valido nel CF"))
-        if not (cf[9].isdigit() and cf[10].isdigit()):
-            raise ValueError(_("Giorno non valido nel CF"))
-        day = int(cf[9]) * 10 + int(cf[10])
-        if day > 40:
-            day -= 40  # donne: 41-71 -> 1-31
-        if day < 1 or day > 31:
-            raise ValueError(_("Giorno non valido nel CF"))
-        return date(year, month, day)
+        return _cf_birth_date(cf)
 
     @api.depends("tessere_ids", "tessere_ids.stato", "tessere_ids.data_scadenza")
     def _compute_tessera_attuale(self):
-        """Calcola la tessera attuale (attiva e non scaduta)"""
-        today = fields.Date.today()
+        """
+        Calcola la tessera attuale (attiva e non scaduta, con la scadenza più lontana) con
+        un'unica ricerca per tutto il recordset.
+        """
+        today = fields.Date.context_today(self)
+        attuali = {}
+        associati = self.filtered("id")
+        if associati.ids:
+            tessere = self.env["tessera"].search_fetch(
+                [
+                    ("associato_id", "in", associati.ids),
+                    ("stato", "=", "attiva"),
+                    ("data_scadenza", ">=", today),
+                ],
+                ["associato_id", "data_scadenza"],
+                order="data_scadenza desc, id desc",
+            )
+            for tessera in tessere:
+                attuali.setdefault(tessera.associato_id.id, tessera)
         for record in self:
-            tessera_attuale = record.tessere_ids.filtered(
-                lambda t: (
-                    t.stato == "attiva" and t.data_scadenza and t.data_scadenza >= today
-                )
-            ).sorted("data_scadenza", reverse=True)
-            if tessera_attuale:
-                record.tessera_attuale_id = tessera_attuale[0]
-                giorni_alla_scadenza = (tessera_attuale[0].data_scadenza - today).days
-                record.tessera_in_scadenza = 0 <= giorni_alla_scadenza <= 30
-            else:
-                record.tessera_attuale_id = False
-                record.tessera_in_scadenza = False
+            tessera = attuali.get(record.id)
+            record.tessera_attuale_id = tessera
+            record.tessera_attuale_scadenza = tessera.data_scadenza if tessera else False
+            record.tessera_in_scadenza = bool(
+                tessera and (tessera.data_scadenza - today).days <= SCADENZA_GIORNI
+            )
+
+    def _ricalcola_tessera_attuale(self):
+        """Ricalcola e salva la tessera attuale dopo modifiche alle tessere fatte in SQL."""
+        for fname in ("tessera_attuale_id", "tessera_attuale_scadenza", "tessera_in_scadenza"):
+            self.env.add_to_compute(self._fields[fname], self)
+        self.flush_recordset(["tessera_attuale_id", "tessera_attuale_scadenza", "tessera_in_scadenza"])
 
     def get_tessere_passate(self):
         """Restituisce le tessere passate (scadute o annullate)"""
         today = fields.Date.today()
-        return self.tessere_ids.filtered(
+        # Incluse le tessere archiviate: lo storico del socio resta completo
+        return self.with_context(active_test=False).tessere_ids.filtered(
             lambda t: (
                 t.stato in ("scaduta", "annullata")
                 or (t.data_scadenza and t.data_scadenza < today)
@@ -469,9 +738,8 @@ class Associato(models.Model):
         user = self.env.user
         if user._is_public():
             raise UserError(_("Devi effettuare l'accesso per reclamare un profilo."))
-        email_user = (user.partner_id.email or user.login or "").strip().lower()
-        email_associato = (self.email or "").strip().lower()
-        if not email_user or email_user != email_associato:
+        email_user = normalize_email(user.partner_id.email or user.login)
+        if not email_user or email_user != self.email_normalized:
             raise UserError(
                 _(
                     "Puoi reclamare solo un profilo associato con la stessa email del tuo account (%s).",
@@ -489,7 +757,7 @@ class Associato(models.Model):
         Se l'utente esiste già (stessa email), lo associa e invia comunque l'email di reset password come invito.
         """
         self.ensure_one()
-        email = (self.email or "").strip().lower()
+        email = self.email_normalized or ""
         if not email:
             raise UserError(
                 _(
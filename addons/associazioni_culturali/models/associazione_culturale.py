@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields, api, _
+from types import SimpleNamespace
+
+from odoo import models, fields, api, tools, _
 
 
 class AssociazioneCulturale(models.Model):
     _name = 'associazione.culturale'
     _description = _('Associazione')
-    _inherit = ['mail.thread', 'mail.activity.mixin']
+    _inherit = ['mail.thread', 'mail.activity.mixin', 'associazioni.cache.mixin']
+    # Campi delle opzioni in cache del form pubblico (_get_tesseramento_form_options)
+    _campi_in_cache = frozenset({'name', 'attivo', 'consenti_registrazione_pubblica'})
 
     name = fields.Char(string='Nome', required=True, tracking=True)
     image_128 = fields.Image(string='Logo', max_width=128, max_height=128)
@@ -34,3 +38,41 @@ class AssociazioneCulturale(models.Model):
     _sql_constraints = [
         ('codice_fiscale_unique', 'unique(codice_fiscale)', _('Il codice fiscale deve essere unico!')),
     ]
+
+    @api.model
+    def _get_public_mailing_lists(self):
+        """Liste mailing pubbliche come oggetti con id, name e description (vuota se il modello non ce l'ha)."""
+        if 'mailing.list' not in self.env:
+            return []
+        records = self.env['mailing.list'].sudo().search([
+            ('active', '=', True),
+            ('is_public', '=', True),
+        ])
+        return [
+            SimpleNamespace(
+                id=m.id,
+                name=m.name,
+                description=getattr(m, 'description', None) or '',
+            )
+            for m in records
+        ]
+
+    @api.model
+    @tools.ormcache('website_id', 'lang')
+    def _get_tesseramento_form_options(self, website_id, lang):
+        """
+        Opzioni del form pubblico /tesseramento (associazioni con registrazione pubblica, piani
+        attivi, liste mailing pubbliche) per sito e lingua, in cache fino alla modifica di
+        associazioni, piani o liste.
+        """
+        Associazione = self.sudo().with_context(lang=lang, website_id=website_id)
+        associazioni = Associazione.search([('attivo', '=', True), ('consenti_registrazione_pubblica', '=', True)])
+        piani = Associazione.env['piano.tesseramento'].search([('attivo', '=', True)])
+        return {
+            'associazioni': tuple(SimpleNamespace(id=a.id, name=a.name) for a in associazioni),
+            'piani': tuple(
+                SimpleNamespace(id=p.id, name=p.name, tipo=p.tipo, costo_tessera=p.costo_tessera)
+                for p in piani
+            ),
+            'mailing_lists': tuple(Associazione._get_public_mailing_lists()),
+        }
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+
+class AssociazioniCacheMixin(models.AbstractModel):
+    """
+    Svuota la cache del registry (ormcache) quando cambiano i record di un modello i cui dati
+    sono in cache altrove, ad esempio le opzioni del form pubblico di tesseramento.
+    Creazione ed eliminazione invalidano sempre; la modifica solo se tocca uno dei campi
+    elencati in ``_campi_in_cache``.
+    """
+
+    _name = 'associazioni.cache.mixin'
+    _description = 'Invalidazione cache su modifica'
+
+    _campi_in_cache = frozenset()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if not self._campi_in_cache.isdisjoint(vals):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
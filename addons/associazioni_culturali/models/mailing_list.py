@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+
+class MailingList(models.Model):
+    _name = 'mailing.list'
+    _inherit = ['mailing.list', 'associazioni.cache.mixin']
+
+    # Le liste pubbliche compaiono nel form di tesseramento (opzioni in cache,
+    # associazione.culturale._get_tesseramento_form_options)
+    _campi_in_cache = frozenset({'name', 'description', 'is_public', 'active'})
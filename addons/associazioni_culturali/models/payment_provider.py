@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models, tools
+
+
+class PaymentProvider(models.Model):
+    _name = 'payment.provider'
+    _inherit = ['payment.provider', 'associazioni.cache.mixin']
+
+    # Campi che determinano il provider in cache (_get_tesseramento_provider_id), ordine compreso
+    _campi_in_cache = frozenset({'state', 'is_published', 'company_id', 'available_currency_ids', 'sequence'})
+
+    def _accetta_tesseramento(self, company_id, currency_id):
+        """Vero se il provider è abilitato, pubblicato, della società e accetta la valuta (nessuna valuta = tutte)."""
+        self.ensure_one()
+        return (
+            self.state == 'enabled'
+            and self.is_published
+            and self.company_id.id == company_id
+            and (not self.available_currency_ids or currency_id in self.available_currency_ids.ids)
+        )
+
+    @api.model
+    @tools.ormcache('company_id', 'currency_id')
+    def _get_tesseramento_provider_id(self, company_id, currency_id):
+        """
+        Primo provider per sequenza, abilitato e pubblicato, della società che accetta la
+        valuta (nessuna valuta configurata = tutte). Risultato in cache per (società, valuta):
+        il form di tesseramento non scansiona i provider a ogni invio. Restituisce l'id o False.
+        """
+        providers = self.sudo().search([
+            ('state', '=', 'enabled'),
+            ('is_published', '=', True),
+            ('company_id', '=', company_id),
+        ], order='sequence, id')
+        for provider in providers:
+            if provider._accetta_tesseramento(company_id, currency_id):
+                return provider.id
+        return False
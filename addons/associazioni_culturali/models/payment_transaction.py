@@ -3,6 +3,8 @@
 from odoo import models, api
 import logging
 
+from .tesseramento_pending import TESSERAMENTO_REFERENCE_PREFIX
+
 _logger = logging.getLogger(__name__)
 
 
@@ -12,21 +14,30 @@ class PaymentTransaction(models.Model):
     def _finalize_post_processing(self):
         """Override per completare il tesseramento dopo il pagamento"""
         super()._finalize_post_processing()
-        
-        # Se la transazione è completata, verifica se è per un tesseramento.
+
+        # Solo le transazioni completate del tesseramento, riconosciute dal prefisso del
+        # riferimento: nessuna query per i pagamenti di ordini, fatture, ecc.
+        transazioni = self.filtered(
+            lambda tx: tx.state == 'done'
+            and (tx.reference or '').startswith(TESSERAMENTO_REFERENCE_PREFIX)
+        )
+        if not transazioni:
+            return
+        # Un'unica ricerca per tutte le transazioni del batch (indice su transaction_id).
         # Usa sudo() perché questo metodo può essere eseguito nel contesto dell'utente
         # portale (callback di pagamento), che non ha permessi su tesseramento.pending/tessera.
-        if self.state == 'done':
-            tesseramento_pending = self.env['tesseramento.pending'].sudo().search([
-                ('transaction_id', '=', self.id),
-                ('stato', 'in', ['pending', 'paid'])
-            ], limit=1)
-            
-            if tesseramento_pending:
-                tesseramento_pending.write({'stato': 'paid'})
-                tessera = tesseramento_pending.action_completa_tessera()
-                if tessera:
-                    _logger.info(f"Tesseramento completato per transazione {self.id}, tessera creata: {tessera.id}")
-                else:
-                    _logger.warning(f"Tesseramento pending {tesseramento_pending.id} non completato per transazione {self.id}")
-                    
+        pendings = self.env['tesseramento.pending'].sudo().search([
+            ('transaction_id', 'in', transazioni.ids),
+            ('stato', 'in', ['pending', 'paid']),
+        ])
+        # Completamento con lock SKIP LOCKED: se il ritorno dal provider sta completando
+        # (o ha già completato) lo stesso pending, questo worker lo salta
+        tessere = pendings._completa_pagamento()
+        for tessera in tessere:
+            tx = tessera.tesseramento_pending_id.transaction_id
+            _logger.info("Tesseramento completato per transazione %s, tessera creata: %s", tx.id, tessera.id)
+        for tesseramento_pending in pendings - tessere.tesseramento_pending_id:
+            _logger.info(
+                "Tesseramento pending %s già completato o in completamento per transazione %s",
+                tesseramento_pending.id, tesseramento_pending.transaction_id.id,
+            )
@@ -6,7 +6,9 @@ from odoo import models, fields, api, _
 class PianoTesseramento(models.Model):
     _name = 'piano.tesseramento'
     _description = _('Piano Tesseramento')
-    _inherit = ['mail.thread', 'mail.activity.mixin']
+    _inherit = ['mail.thread', 'mail.activity.mixin', 'associazioni.cache.mixin']
+    # Campi delle opzioni in cache del form pubblico di tesseramento
+    _campi_in_cache = frozenset({'name', 'tipo', 'costo_tessera', 'attivo'})
 
     name = fields.Char(string='Nome Piano', required=True, tracking=True)
     tipo = fields.Selection([
@@ -20,6 +22,12 @@ class PianoTesseramento(models.Model):
     anno_riferimento = fields.Integer(string='Anno di Riferimento', 
                                        help='Anno solare di riferimento (solo per tipo annuale solare)')
     attivo = fields.Boolean(string='Attivo', default=True)
+    provider_id = fields.Many2one(
+        'payment.provider', string='Provider di pagamento preferito',
+        domain="[('state', '=', 'enabled')]",
+        help='Provider usato per i pagamenti di questo piano. Se vuoto (o non più abilitato) '
+             'viene usato il primo provider abilitato e pubblicato che accetta la valuta del piano.',
+    )
     note = fields.Text(string='Note')
     
     # Relazioni inverse
@@ -40,3 +48,15 @@ class PianoTesseramento(models.Model):
         if vals.get('tipo') == 'annuale_solare' and not vals.get('anno_riferimento'):
             vals['anno_riferimento'] = self._get_default_anno_riferimento()
         return super().write(vals)
+
+    def _get_payment_provider(self, company):
+        """
+        Provider per i pagamenti del piano: il preferito se abilitato, pubblicato, della società
+        e compatibile con la valuta del piano, altrimenti quello in cache per valuta.
+        """
+        self.ensure_one()
+        Provider = self.env['payment.provider'].sudo()
+        provider = Provider.browse(self.sudo().provider_id.id)
+        if provider and provider._accetta_tesseramento(company.id, self.currency_id.id):
+            return provider
+        return Provider.browse(Provider._get_tesseramento_provider_id(company.id, self.currency_id.id))
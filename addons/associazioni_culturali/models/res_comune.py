@@ -1,6 +1,29 @@
 # -*- coding: utf-8 -*-
 
-from odoo import api, fields, models
+import bisect
+import gzip
+import hashlib
+import io
+import json
+import logging
+import re
+import unicodedata
+
+from odoo import api, fields, models, tools
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+COMUNI_CSV_PATH = "associazioni_culturali/data/res.comune.csv"
+COMUNI_CSV_HASH_PARAM = "associazioni_culturali.res_comune_csv_hash"
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+
+def _fold(text):
+    """Normalizza per la ricerca: senza accenti, minuscolo, separatori ridotti a un solo spazio."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_ALNUM_RE.sub(" ", text.casefold()).strip()
 
 
 class ResComune(models.Model):
@@ -14,6 +37,13 @@ class ResComune(models.Model):
     codice_istat = fields.Char(string="Codice ISTAT")
     cap = fields.Char(string="CAP")
     active = fields.Boolean(default=True, string="Attivo")
+    # Nome senza accenti e minuscolo, indicizzato con pg_trgm per name_search
+    name_search_key = fields.Char(
+        string="Chiave di ricerca",
+        compute="_compute_name_search_key",
+        store=True,
+        index="trigram",
+    )
 
     _sql_constraints = [
         (
@@ -23,23 +53,296 @@ class ResComune(models.Model):
         ),
     ]
 
-    @api.model
-    def name_search(self, name="", args=None, operator="ilike", limit=100):
-        args = args or []
-        domain = []
-        if name:
-            domain = [
-                "|",
-                ("name", operator, name),
-                ("codice_catastale", operator, name),
-            ]
-        return self._search(domain + args, limit=limit)  # Restituisce una lista di ID
-
-    def name_get(self):
-        result = []
+    @api.depends("name")
+    def _compute_name_search_key(self):
+        for record in self:
+            record.name_search_key = _fold(record.name)
+
+    @api.depends("name", "provincia")
+    def _compute_display_name(self):
         for record in self:
             name = record.name
             if record.provincia:
                 name = f"{name} ({record.provincia})"
-            result.append((record.id, name))
-        return result
+            record.display_name = name
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    def _load_comuni_csv(self):
+        """
+        Carica ``data/res.comune.csv`` in blocco, chiamato dai dati del modulo a ogni
+        installazione/aggiornamento al posto dell'import CSV dell'ORM. Il file viene copiato
+        con COPY in una tabella temporanea e poi allineato a ``res_comune`` e ``ir_model_data``
+        con poche query set-based. Se l'hash del file non è cambiato dall'ultimo caricamento
+        non fa nulla.
+
+        Gli xmlid dei comuni sono registrati come noupdate: non passando dal loader dati,
+        altrimenti verrebbero eliminati a fine aggiornamento come record non più presenti.
+        I comuni soppressi restano nel file con ``active`` falso (vedi ``data/convert_comuni.py``),
+        così i codici catastali storici dei codici fiscali restano risolvibili; quelli tolti
+        del tutto dal file vengono archiviati, non eliminati (possono essere referenziati).
+        """
+        with tools.file_open(COMUNI_CSV_PATH, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        ICP = self.env["ir.config_parameter"].sudo()
+        cr = self.env.cr
+        cr.execute(
+            "SELECT 1 FROM ir_model_data WHERE module = %s AND model = %s LIMIT 1",
+            ["associazioni_culturali", self._name],
+        )
+        if ICP.get_param(COMUNI_CSV_HASH_PARAM) == digest and cr.rowcount:
+            return False
+
+        self.env.flush_all()
+        cr.execute("DROP TABLE IF EXISTS res_comune_import")
+        cr.execute(
+            """
+            CREATE TEMP TABLE res_comune_import (
+                xmlid varchar, name varchar, codice_catastale varchar,
+                provincia varchar, codice_istat varchar, cap varchar, active boolean
+            ) ON COMMIT DROP
+            """
+        )
+        cr.copy_expert(
+            "COPY res_comune_import FROM STDIN WITH (FORMAT csv, HEADER true)",
+            io.BytesIO(content),
+        )
+        params = {"uid": self.env.uid, "module": "associazioni_culturali", "model": self._name}
+
+        # Aggiorna solo i comuni effettivamente cambiati (match sul codice catastale)
+        cr.execute(
+            """
+            UPDATE res_comune c
+               SET name = i.name,
+                   provincia = NULLIF(i.provincia, ''),
+                   codice_istat = NULLIF(i.codice_istat, ''),
+                   cap = NULLIF(i.cap, ''),
+                   active = i.active,
+                   write_uid = %(uid)s,
+                   write_date = now() at time zone 'UTC'
+              FROM res_comune_import i
+             WHERE c.codice_catastale = i.codice_catastale
+               AND (c.name, c.provincia, c.codice_istat, c.cap, c.active)
+                   IS DISTINCT FROM
+                   (i.name, NULLIF(i.provincia, ''), NULLIF(i.codice_istat, ''),
+                    NULLIF(i.cap, ''), i.active)
+         RETURNING c.id
+            """,
+            params,
+        )
+        changed_ids = [row[0] for row in cr.fetchall()]
+        updated = len(changed_ids)
+        cr.execute(
+            """
+            INSERT INTO res_comune (name, codice_catastale, provincia, codice_istat, cap, active,
+                                    create_uid, create_date, write_uid, write_date)
+            SELECT i.name, i.codice_catastale, NULLIF(i.provincia, ''), NULLIF(i.codice_istat, ''),
+                   NULLIF(i.cap, ''), i.active,
+                   %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+              FROM res_comune_import i
+             WHERE NOT EXISTS (
+                   SELECT 1 FROM res_comune c WHERE c.codice_catastale = i.codice_catastale)
+         RETURNING id
+            """,
+            params,
+        )
+        inserted_ids = [row[0] for row in cr.fetchall()]
+        changed_ids += inserted_ids
+
+        # xmlid del modulo per ogni comune del file
+        cr.execute(
+            """
+            INSERT INTO ir_model_data (module, name, model, res_id, noupdate,
+                                       create_uid, create_date, write_uid, write_date)
+            SELECT %(module)s, i.xmlid, %(model)s, c.id, true,
+                   %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+              FROM res_comune_import i
+              JOIN res_comune c ON c.codice_catastale = i.codice_catastale
+                ON CONFLICT (module, name) DO UPDATE
+               SET res_id = EXCLUDED.res_id, noupdate = true
+             WHERE ir_model_data.res_id IS DISTINCT FROM EXCLUDED.res_id
+                OR ir_model_data.noupdate IS NOT TRUE
+            """,
+            params,
+        )
+
+        # Comuni del modulo non più presenti nel file: archiviati
+        cr.execute(
+            """
+            UPDATE res_comune c
+               SET active = false, write_uid = %(uid)s, write_date = now() at time zone 'UTC'
+              FROM ir_model_data d
+             WHERE d.module = %(module)s AND d.model = %(model)s AND d.res_id = c.id
+               AND c.active
+               AND NOT EXISTS (
+                   SELECT 1 FROM res_comune_import i WHERE i.xmlid = d.name)
+            """,
+            params,
+        )
+        archived = cr.rowcount
+        cr.execute("DROP TABLE res_comune_import")
+
+        self.env.invalidate_all()
+        if changed_ids:
+            records = self.browse(changed_ids)
+            self.env.add_to_compute(self._fields["name_search_key"], records)
+            records.flush_recordset(["name_search_key"])
+        self.env.registry.clear_cache()
+        ICP.set_param(COMUNI_CSV_HASH_PARAM, digest)
+        _logger.info(
+            "Comuni caricati da %s: %s nuovi, %s aggiornati, %s archiviati",
+            COMUNI_CSV_PATH,
+            len(inserted_ids),
+            updated,
+            archived,
+        )
+        return True
+
+    @api.model
+    @tools.ormcache("comune_id")
+    def _get_comune_cf_data(self, comune_id):
+        """Nome e codice catastale del comune, in cache LRU per worker (invalidata alla modifica dei comuni)."""
+        comune = self.sudo().with_context(active_test=False).browse(comune_id).exists()
+        if not comune:
+            return None
+        return comune.name, comune.codice_catastale
+
+    @api.model
+    @tools.ormcache()
+    def _get_comuni_search_index(self):
+        """
+        Indice in memoria (per worker) dei comuni attivi per l'autocomplete pubblico.
+        Restituisce (voci, nomi, codici): voci è una tupla di (id, testo, nome normalizzato,
+        codice catastale minuscolo, provincia minuscola); nomi e codici sono liste ordinate di
+        (chiave, posizione) usate per la ricerca per prefisso con bisect.
+        Costruito alla prima richiesta, invalidato con la cache del registry.
+        """
+        entries = tuple(
+            (
+                c["id"],
+                f"{c['name']} ({c['provincia']})" if c["provincia"] else c["name"],
+                _fold(c["name"]),
+                (c["codice_catastale"] or "").lower(),
+                (c["provincia"] or "").lower(),
+            )
+            for c in self.sudo().search_read(
+                [], ["name", "provincia", "codice_catastale"], order="name, id"
+            )
+        )
+        names = sorted((entry[2], pos) for pos, entry in enumerate(entries))
+        codes = sorted((entry[3], pos) for pos, entry in enumerate(entries))
+        return entries, names, codes
+
+    @api.model
+    @tools.ormcache()
+    def _get_comuni_snapshot(self):
+        """
+        Snapshot JSON compatto dei comuni attivi per l'autocomplete lato client: lista di
+        [id, testo, nome normalizzato, codice catastale, provincia] in minuscolo, come l'indice
+        in memoria. Restituisce (versione, json, json gzip); la versione è l'hash del contenuto,
+        quindi identica su tutti i worker e cambia solo quando cambiano i comuni.
+        """
+        entries = self._get_comuni_search_index()[0]
+        payload = json.dumps(entries, ensure_ascii=False, separators=(",", ":")).encode()
+        version = hashlib.sha256(payload).hexdigest()[:16]
+        return version, payload, gzip.compress(payload, mtime=0)
+
+    @api.model
+    def _get_comuni_snapshot_url(self):
+        return "/tesseramento/comuni/%s.json" % self._get_comuni_snapshot()[0]
+
+    @api.model
+    def _search_comuni_index(self, term, limit=30):
+        """
+        Ricerca comuni sull'indice in memoria, con risultati ordinati per rilevanza:
+        nome o codice catastale esatto, poi prefisso del nome o del codice, poi prefisso
+        di una parola del nome, poi sottostringa, infine sigla della provincia.
+        Restituisce una lista di dict {id, text} per Select2.
+        """
+        entries, names, codes = self._get_comuni_search_index()
+        folded = _fold(term)
+        if not folded:
+            return [{"id": e[0], "text": e[1]} for e in entries[:limit]]
+        ranked = {}
+
+        def add(pos, rank):
+            if ranked.get(pos, rank + 1) > rank:
+                ranked[pos] = rank
+
+        def add_prefix(keys, prefix):
+            # I prefissi formano un intervallo contiguo nelle chiavi ordinate
+            start = bisect.bisect_left(keys, (prefix,))
+            for key, pos in keys[start:]:
+                if not key.startswith(prefix):
+                    break
+                add(pos, 0 if key == prefix else 1)
+
+        add_prefix(names, folded)
+        compact = folded.replace(" ", "")
+        if len(compact) > 1:
+            add_prefix(codes, compact)
+        # Parole interne e sottostringhe solo se i prefissi non bastano a riempire i risultati
+        if len(ranked) < limit:
+            word = " " + folded
+            for pos, entry in enumerate(entries):
+                if pos in ranked:
+                    continue
+                if word in entry[2]:
+                    add(pos, 2)
+                elif folded in entry[2]:
+                    add(pos, 3)
+                elif entry[4] == compact:
+                    add(pos, 4)
+        best = sorted(ranked, key=lambda pos: (ranked[pos], pos))[:limit]
+        return [{"id": entries[pos][0], "text": entries[pos][1]} for pos in best]
+
+    @api.model
+    def name_search(self, name="", domain=None, operator="ilike", limit=100):
+        """
+        Ricerca per i many2one del backend: nome senza accenti (indice trigram su
+        name_search_key) o codice catastale esatto. I risultati sono ordinati per
+        codice esatto, nome esatto, prefisso del nome e infine similarità trigram.
+        """
+        folded = _fold(name)
+        if operator != "ilike" or not folded:
+            return super().name_search(name, domain, operator, limit)
+        query = self._search(domain or [])
+        key = SQL.identifier(self._table, "name_search_key")
+        code = SQL.identifier(self._table, "codice_catastale")
+        contains = f"%{folded}%"
+        prefix = f"{folded}%"
+        compact = folded.replace(" ", "").upper()
+        if self.env.registry.has_trigram:
+            # %% (similarità sopra soglia) recupera anche i nomi con errori di battitura
+            query.add_where(SQL(
+                "(%s LIKE %s OR %s %% %s OR %s = %s)",
+                key, contains, key, folded, code, compact,
+            ))
+            similarity = SQL("similarity(%s, %s) DESC,", key, folded)
+        else:
+            query.add_where(SQL("(%s LIKE %s OR %s = %s)", key, contains, code, compact))
+            similarity = SQL()
+        query.order = SQL(
+            "%s = %s DESC, %s = %s DESC, %s LIKE %s DESC, %s %s, %s",
+            code, compact, key, folded, key, prefix, similarity,
+            SQL.identifier(self._table, "name"), SQL.identifier(self._table, "id"),
+        )
+        query.limit = limit
+        records = self.browse(query.get_result_ids())
+        return [(record.id, record.display_name) for record in records]
@@ -1,13 +1,72 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 from datetime import datetime, timedelta
 
+from dateutil.relativedelta import relativedelta
+from markupsafe import Markup
+
 from odoo import _, api, fields, models
+from odoo.addons.base.models.ir_mail_server import MailDeliveryException
 from odoo.exceptions import UserError
+from odoo.tools import SQL
+from odoo.tools.sql import index_exists
+
+from .associato import SCADENZA_GIORNI
 
 _logger = logging.getLogger(__name__)
 
+# Tessere per messaggio di tracciamento creato in blocco dal cron delle scadenze
+_TRACKING_BATCH_SIZE = 1000
+# Email di conferma renderizzate insieme (send_mail_batch) se non è impostato un limite al minuto
+_EMAIL_BATCH_SIZE = 500
+EMAIL_CONFERMA_RATE_PARAM = "associazioni_culturali.email_conferma_per_minuto"
+# Contesto per la creazione massiva di tessere (import, rinnovi): niente messaggio di
+# creazione, valori di tracciamento e iscrizione dei follower per ogni tessera
+BULK_CREATE_CONTEXT = {"tracking_disable": True}
+# Orizzonte di archiviazione: tessere scadute/annullate da più di N anni (0 = disattivata)
+ARCHIVIO_TESSERE_ANNI_PARAM = "associazioni_culturali.archivio_tessere_anni"
+ARCHIVIO_TESSERE_ANNI_DEFAULT = 3
+# Record archiviati per statement (e per commit, fuori dai test)
+_ARCHIVIO_BATCH_SIZE = 5000
+
+
+def archivia_in_blocchi(model, condition, batch_size=_ARCHIVIO_BATCH_SIZE):
+    """
+    Archivia (active=False) i record attivi di ``model`` che soddisfano ``condition`` (SQL),
+    con UPDATE a blocchi di ``batch_size`` righe; i record bloccati da altre transazioni
+    vengono saltati e ripresi all'esecuzione successiva. Restituisce i record archiviati.
+    """
+    cr = model.env.cr
+    model.flush_model()
+    total = 0
+    while True:
+        cr.execute(SQL(
+            """
+            UPDATE %(table)s
+               SET active = false, write_uid = %(uid)s, write_date = now() at time zone 'UTC'
+             WHERE id IN (
+                    SELECT id FROM %(table)s
+                     WHERE active AND %(condition)s
+                     LIMIT %(limit)s
+                       FOR UPDATE SKIP LOCKED
+                   )
+            """,
+            table=SQL.identifier(model._table),
+            uid=model.env.uid,
+            condition=condition,
+            limit=batch_size,
+        ))
+        total += cr.rowcount
+        if cr.rowcount < batch_size:
+            break
+        # Transazioni brevi sulle tabelle calde (non nei test, che girano in un'unica transazione)
+        if not model.env.registry.in_test_mode():
+            cr.commit()
+    model.invalidate_model(["active", "write_uid", "write_date"])
+    return total
+
 
 class Tessera(models.Model):
     _name = "tessera"
@@ -15,7 +74,13 @@ class Tessera(models.Model):
     _inherit = ["mail.thread", "mail.activity.mixin"]
     _order = "data_emissione desc, id desc"
 
-    name = fields.Char(string="Numero Tessera", compute="_compute_name", store=True)
+    name = fields.Char(
+        string="Numero Tessera",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="Progressivo per associazione e anno di emissione, assegnato alla creazione.",
+    )
     piano_id = fields.Many2one(
         "piano.tesseramento", string="Piano Tesseramento", required=True, tracking=True
     )
@@ -36,6 +101,7 @@ class Tessera(models.Model):
         string="Data Scadenza",
         compute="_compute_data_scadenza",
         store=True,
+        precompute=True,
         tracking=True,
     )
     stato = fields.Selection(
@@ -47,8 +113,8 @@ class Tessera(models.Model):
         string="Stato",
         compute="_compute_stato",
         store=True,
+        precompute=True,
         readonly=False,
-        default="attiva",
     )
     importo_pagato = fields.Monetary(
         string="Importo Pagato", currency_field="currency_id", tracking=True
@@ -59,59 +125,201 @@ class Tessera(models.Model):
         default=lambda self: self.env.company.currency_id,
     )
     note = fields.Text(string="Note")
+    active = fields.Boolean(
+        string="Attiva",
+        default=True,
+        help="Le tessere storiche vengono archiviate dal cron di archiviazione: restano "
+        "consultabili dalla scheda dell'associato ma escono dalle tabelle di lavoro.",
+    )
+    tesseramento_pending_id = fields.Many2one(
+        "tesseramento.pending",
+        string="Tesseramento di origine",
+        readonly=True,
+        copy=False,
+        ondelete="set null",
+        index="btree_not_null",
+        help="Tesseramento online (pagamento) da cui è stata creata la tessera.",
+    )
     invia_email_conferma = fields.Boolean(
         string="Invia email di conferma al socio",
         default=True,
         help="Se attivo, alla creazione della tessera viene inviata un'email al socio con i dettagli. Disattivare solo in creazione da backend se non si desidera inviare.",
     )
 
-    @api.depends("piano_id", "associato_id", "associazione_id", "data_emissione")
-    def _compute_name(self):
-        for record in self:
-            if record.piano_id and record.associato_id and record.associazione_id:
-                # Formato: ASSOCIAZIONE-ASSOCIATO-ANNO-NUMERO (id usato solo se già salvato)
-                anno = (
-                    record.data_emissione.year
-                    if record.data_emissione
-                    else fields.Date.today().year
-                )
-                nome_associazione = (
-                    record.associazione_id.name[:3].upper()
-                    if len(record.associazione_id.name) >= 3
-                    else record.associazione_id.name.upper()
-                )
-                associato_id = record.associato_id.id if record.associato_id else "N/A"
-                tessera_id = record.id if record.id else "NEW"
-                record.name = f"{nome_associazione}-{associato_id}-{anno}-{tessera_id}"
-            else:
-                record.name = "Nuova Tessera"
+    _tesseramento_pending_uniq = models.Constraint(
+        "unique(tesseramento_pending_id)",
+        "Per questo tesseramento è già stata creata una tessera.",
+    )
+
+    def init(self):
+        # Indice parziale per il cron delle scadenze: solo le tessere attive, ordinate per scadenza
+        indexname = "tessera_attiva_data_scadenza_idx"
+        if not index_exists(self.env.cr, indexname):
+            self.env.cr.execute(
+                f"CREATE INDEX {indexname} ON tessera (data_scadenza) WHERE stato = 'attiva'"
+            )
+        # Tessere per associato (tessere_ids, regole portale) escluse quelle archiviate
+        indexname = "tessera_associato_active_idx"
+        if not index_exists(self.env.cr, indexname):
+            self.env.cr.execute(
+                f"CREATE INDEX {indexname} ON tessera (associato_id) WHERE active"
+            )
+
+    @api.model
+    def _assegna_numeri(self, vals_list):
+        """
+        Imposta ``name`` nei valori di creazione: ASSOCIAZIONE-ANNO-NUMERO, con un progressivo
+        per associazione e anno di emissione riservato in blocco (una query per tutto il batch).
+        """
+        da_numerare = [vals for vals in vals_list if not vals.get("name") and vals.get("associazione_id")]
+        if not da_numerare:
+            return
+        today = fields.Date.today()
+        keys = [
+            (vals["associazione_id"], (fields.Date.to_date(vals.get("data_emissione")) or today).year)
+            for vals in da_numerare
+        ]
+        richieste = {}
+        for key in keys:
+            richieste[key] = richieste.get(key, 0) + 1
+        primi = self.env["tessera.numerazione"]._riserva_numeri(richieste)
+        prefissi = {
+            associazione.id: associazione.name[:3].upper()
+            for associazione in self.env["associazione.culturale"].browse(
+                list({associazione_id for associazione_id, _anno in richieste})
+            )
+        }
+        for vals, key in zip(da_numerare, keys):
+            associazione_id, anno = key
+            vals["name"] = f"{prefissi[associazione_id]}-{anno}-{primi[key]:05d}"
+            primi[key] += 1
 
     @api.model_create_multi
     def create(self, vals_list):
+        # Numero assegnato prima dell'INSERT: nessuna riscrittura del nome dopo la creazione
+        self._assegna_numeri(vals_list)
         records = super().create(vals_list)
-        # Ricalcola il nome ora che i record hanno id (non si può usare id in @api.depends)
-        records._compute_name()
-        # Flush tutti i campi (nome e campi computati data_scadenza, stato) prima dell'invio email
-        records.flush_recordset()
-        # Invia email di conferma per le tessere con invia_email_conferma=True
-        for record in records:
-            if record.invia_email_conferma and record.associato_id.email:
-                record._send_email_conferma_tessera()
+        # Email di conferma accodate in blocco per le tessere con invia_email_conferma=True
+        records.filtered("invia_email_conferma")._send_email_conferma_tessera()
         return records
 
-    def _send_email_conferma_tessera(self):
-        """Invia email di conferma al socio: tessera generata."""
-        self.ensure_one()
-        try:
-            template = self.env.ref(
-                "associazioni_culturali.email_template_tessera_creata", False
-            )
-            if template and self.associato_id.email:
-                template.send_mail(self.id, force_send=True)
-        except Exception as e:
-            _logger.warning(
-                "Impossibile inviare email di conferma tessera %s: %s", self.id, str(e)
+    @api.model
+    def _crea_in_blocco(self, vals_list, origine):
+        """
+        Creazione massiva di tessere senza tracciamento né follower per record: al posto dei
+        messaggi di ogni tessera viene registrato un solo riepilogo per associazione.
+        """
+        tessere = self.with_context(**BULK_CREATE_CONTEXT).create(vals_list)
+        for associazione, gruppo in tessere.grouped("associazione_id").items():
+            self._log_creazione_in_blocco(associazione, len(gruppo), origine)
+        return tessere.with_env(self.env)
+
+    @api.model
+    def _log_creazione_in_blocco(self, associazione, count, origine):
+        """Messaggio riepilogativo sull'associazione per una creazione massiva di tessere."""
+        if not count:
+            return
+        body = Markup("<p>%s</p>") % (_("%s tessere create in blocco: %s") % (count, origine))
+        associazione.sudo()._message_log(body=body)
+
+    def action_rinnova_in_blocco(self):
+        """
+        Rinnova le tessere selezionate scadute o in scadenza (entro SCADENZA_GIORNI) con una
+        sola creazione massiva, stesso piano. La nuova tessera decorre dal giorno dopo la
+        scadenza della precedente (o da oggi, se già scaduta). Salta i soci che nella stessa
+        associazione hanno già una tessera con scadenza successiva.
+        """
+        today = fields.Date.today()
+        limite = today + timedelta(days=SCADENZA_GIORNI)
+        da_rinnovare = self.filtered(
+            lambda t: t.stato != "annullata" and t.data_scadenza and t.data_scadenza <= limite
+        )
+        ultima_scadenza = {
+            (associato.id, associazione.id): data_scadenza
+            for associato, associazione, data_scadenza in self._read_group(
+                [
+                    ("associato_id", "in", da_rinnovare.associato_id.ids),
+                    ("associazione_id", "in", da_rinnovare.associazione_id.ids),
+                    ("stato", "!=", "annullata"),
+                ],
+                ["associato_id", "associazione_id"],
+                ["data_scadenza:max"],
             )
+        }
+        vals_list = []
+        rinnovati = set()
+        for tessera in da_rinnovare.sorted("data_scadenza", reverse=True):
+            key = (tessera.associato_id.id, tessera.associazione_id.id)
+            if key in rinnovati or ultima_scadenza.get(key, tessera.data_scadenza) > tessera.data_scadenza:
+                continue
+            data_emissione = max(today, tessera.data_scadenza + timedelta(days=1))
+            piano = tessera.piano_id
+            # Un piano solare di un anno già coperto non può rinnovare la tessera
+            if piano.tipo == "annuale_solare" and piano.anno_riferimento and piano.anno_riferimento < data_emissione.year:
+                continue
+            rinnovati.add(key)
+            vals_list.append({
+                "associato_id": tessera.associato_id.id,
+                "associazione_id": tessera.associazione_id.id,
+                "piano_id": piano.id,
+                "data_emissione": data_emissione,
+                "currency_id": tessera.currency_id.id,
+                "invia_email_conferma": tessera.invia_email_conferma,
+            })
+        tessere = self._crea_in_blocco(vals_list, _("rinnovo massivo"))
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Rinnovo tessere"),
+                "message": _("Create %s tessere, %s saltate (già rinnovate o non in scadenza).")
+                % (len(tessere), len(self) - len(tessere)),
+                "type": "success",
+                "sticky": False,
+                "next": {"type": "ir.actions.act_window_close"},
+            },
+        }
+
+    def _send_email_conferma_tessera(self):
+        """
+        Accoda le email di conferma (tessera generata) per le tessere del recordset. Il template
+        viene renderizzato a blocchi con send_mail_batch e le mail partono dalla coda di Odoo
+        (cron delle email), quindi richiesta, import o callback di pagamento non attendono l'SMTP.
+        Con il parametro ``associazioni_culturali.email_conferma_per_minuto`` le mail vengono
+        programmate a blocchi di quella dimensione, uno al minuto.
+        """
+        tessere = self.filtered(lambda t: t.associato_id.email)
+        template = self.env.ref("associazioni_culturali.email_template_tessera_creata", False)
+        if not tessere or not template:
+            return
+        per_minuto = int(
+            self.env["ir.config_parameter"].sudo().get_param(EMAIL_CONFERMA_RATE_PARAM) or 0
+        )
+        batch_size = per_minuto if per_minuto > 0 else _EMAIL_BATCH_SIZE
+        now = fields.Datetime.now()
+        scheduled = []
+        for i, start in enumerate(range(0, len(tessere), batch_size)):
+            batch = tessere[start:start + batch_size]
+            when = now + timedelta(minutes=i) if per_minuto > 0 else now
+            try:
+                # Savepoint: un blocco non accodato non lascia mail a metà nella transazione;
+                # gli errori di database non vengono intercettati e interrompono l'operazione
+                with self.env.cr.savepoint():
+                    template.send_mail_batch(
+                        batch.ids,
+                        force_send=False,
+                        email_values={"scheduled_date": when} if when != now else None,
+                    )
+            except (UserError, MailDeliveryException) as e:
+                # Rendering del template fallito o mail non accodabile
+                _logger.warning(
+                    "Impossibile accodare le email di conferma per le tessere %s: %s", batch.ids, str(e)
+                )
+                continue
+            scheduled.append(when)
+        cron = self.env.ref("mail.ir_cron_mail_scheduler_action", False)
+        if cron and scheduled:
+            cron.sudo()._trigger(at=scheduled)
 
     def action_reinvia_email_conferma(self):
         """Reinvia l'email di conferma tessera al socio (da backend)."""
@@ -125,8 +333,8 @@ class Tessera(models.Model):
             "type": "ir.actions.client",
             "tag": "display_notification",
             "params": {
-                "title": _("Email inviata"),
-                "message": _("Email di conferma tessera inviata a %s")
+                "title": _("Email in invio"),
+                "message": _("Email di conferma tessera accodata per %s")
                 % self.associato_id.email,
                 "type": "success",
                 "sticky": False,
@@ -184,10 +392,135 @@ class Tessera(models.Model):
 
     @api.model
     def _cron_aggiorna_stati(self):
-        """Cron job per aggiornare gli stati delle tessere scadute"""
-        today = fields.Date.today()
-        tessere_scadute = self.search(
-            [("stato", "=", "attiva"), ("data_scadenza", "<", today)]
+        """
+        Cron job per aggiornare gli stati delle tessere scadute. Lo stato calcolato vale solo
+        al momento della scrittura: le transizioni dovute al passare del tempo (attiva ->
+        scaduta) sono applicate qui con un unico UPDATE sull'indice parziale delle tessere
+        attive, con un messaggio nel chatter per ogni tessera e il resoconto dell'esecuzione.
+        Aggiorna anche la tessera attuale memorizzata sugli associati interessati.
+        """
+        started = time.perf_counter()
+        today = fields.Date.context_today(self)
+        self.flush_model(["stato", "data_scadenza"])
+        self.env.cr.execute(
+            """
+            UPDATE tessera
+               SET stato = 'scaduta', write_uid = %s, write_date = now() at time zone 'UTC'
+             WHERE stato = 'attiva' AND data_scadenza < %s
+         RETURNING id, associato_id
+            """,
+            [self.env.uid, today],
+        )
+        rows = self.env.cr.fetchall()
+        ids = [row[0] for row in rows]
+        self.invalidate_model(["stato", "write_uid", "write_date"])
+        # L'UPDATE non passa dall'ORM: tessera attuale ricalcolata per i soci delle tessere
+        # scadute e per quelli la cui tessera attuale entra oggi nel periodo "in scadenza"
+        Associato = self.env["associato"]
+        soglia = today + timedelta(days=SCADENZA_GIORNI)
+        associati = Associato.browse({row[1] for row in rows}) | Associato.search([
+            ("tessera_attuale_scadenza", "!=", False),
+            "|",
+            ("tessera_attuale_scadenza", "<", today),
+            "&",
+            ("tessera_in_scadenza", "=", False),
+            ("tessera_attuale_scadenza", "<=", soglia),
+        ])
+        associati._ricalcola_tessera_attuale()
+        body = Markup("<p>%s</p>") % _("Stato: Attiva → Scaduta (scadenza superata)")
+        for start in range(0, len(ids), _TRACKING_BATCH_SIZE):
+            batch = self.browse(ids[start:start + _TRACKING_BATCH_SIZE])
+            batch._message_log_batch(bodies=dict.fromkeys(batch.ids, body))
+        run = self.env["tessera.aggiornamento.stati"].create({
+            "data_riferimento": today,
+            "tessere_scadute": len(ids),
+            "durata": time.perf_counter() - started,
+        })
+        _logger.info("Aggiornamento stati tessere: %s scadute in %.2fs", len(ids), run.durata)
+        return run
+
+    @api.model
+    def _cron_archivia_storico(self):
+        """
+        Archivia le tessere scadute o annullate con scadenza precedente all'orizzonte
+        configurato (parametro di sistema associazioni_culturali.archivio_tessere_anni).
+        """
+        anni = int(
+            self.env["ir.config_parameter"].sudo().get_param(
+                ARCHIVIO_TESSERE_ANNI_PARAM, ARCHIVIO_TESSERE_ANNI_DEFAULT
+            )
+            or 0
+        )
+        if anni <= 0:
+            return 0
+        limite = fields.Date.context_today(self) - relativedelta(years=anni)
+        count = archivia_in_blocchi(
+            self, SQL("stato IN ('scaduta', 'annullata') AND data_scadenza < %s", limite)
         )
-        tessere_scadute.write({"stato": "scaduta"})
-        tessere_scadute.write({"stato": "scaduta"})
+        _logger.info("Archiviate %s tessere scadute prima del %s", count, limite)
+        return count
+
+
+class TesseraNumerazione(models.Model):
+    _name = "tessera.numerazione"
+    _description = "Numerazione tessere per associazione e anno"
+    _order = "associazione_id, anno desc"
+
+    associazione_id = fields.Many2one(
+        "associazione.culturale", string="Associazione", required=True, ondelete="cascade"
+    )
+    anno = fields.Integer(string="Anno", required=True)
+    ultimo_numero = fields.Integer(string="Ultimo numero assegnato", readonly=True)
+
+    # Necessario per INSERT ... ON CONFLICT in _riserva_numeri
+    _associazione_anno_uniq = models.Constraint(
+        "unique(associazione_id, anno)",
+        "Esiste già un contatore per questa associazione e questo anno.",
+    )
+
+    @api.model
+    def _riserva_numeri(self, richieste):
+        """
+        Riserva i numeri richiesti, {(associazione_id, anno): quantità}, con un solo
+        INSERT ... ON CONFLICT DO UPDATE. La riga di ogni contatore resta bloccata fino al commit:
+        le creazioni concorrenti attendono e un rollback restituisce i numeri, quindi la
+        numerazione non ha buchi. Restituisce {(associazione_id, anno): primo numero riservato}.
+        """
+        if not richieste:
+            return {}
+        values = SQL(", ").join(
+            SQL(
+                "(%s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')",
+                associazione_id, anno, quantita, self.env.uid, self.env.uid,
+            )
+            for (associazione_id, anno), quantita in sorted(richieste.items())
+        )
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO tessera_numerazione
+                   (associazione_id, anno, ultimo_numero, create_uid, create_date, write_uid, write_date)
+            VALUES %s
+                ON CONFLICT (associazione_id, anno) DO UPDATE
+               SET ultimo_numero = tessera_numerazione.ultimo_numero + EXCLUDED.ultimo_numero,
+                   write_uid = EXCLUDED.write_uid,
+                   write_date = EXCLUDED.write_date
+         RETURNING associazione_id, anno, ultimo_numero
+            """,
+            values,
+        ))
+        result = {
+            (associazione_id, anno): ultimo - richieste[(associazione_id, anno)] + 1
+            for associazione_id, anno, ultimo in self.env.cr.fetchall()
+        }
+        self.invalidate_model(["ultimo_numero"])
+        return result
+
+
+class TesseraAggiornamentoStati(models.Model):
+    _name = "tessera.aggiornamento.stati"
+    _description = "Esecuzione aggiornamento stati tessere"
+    _order = "id desc"
+
+    data_riferimento = fields.Date(string="Data di riferimento", readonly=True)
+    tessere_scadute = fields.Integer(string="Tessere scadute", readonly=True)
+    durata = fields.Float(string="Durata (s)", readonly=True)
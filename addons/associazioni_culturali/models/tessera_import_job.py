@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import contextlib
+import csv
+import io
+import itertools
+import json
+import logging
+import time
+from datetime import datetime
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+
+from .associato import _cf_canonical, normalize_email, validate_codici_fiscali
+from .tessera import BULK_CREATE_CONTEXT
+
+_logger = logging.getLogger(__name__)
+
+# Tempo massimo di elaborazione per esecuzione del cron (secondi), ben sotto limit_time_real:
+# allo scadere il job salva il punto raggiunto e il cron viene riattivato per proseguire
+_JOB_TIME_BUDGET = 300
+# Byte letti all'inizio del file per dedurre encoding e separatore
+_SNIFF_SIZE = 64 * 1024
+
+
+def _sniff_encoding(sample):
+    """UTF-8 (con o senza BOM) se l'inizio del file è UTF-8 valido, altrimenti Latin-1."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # final=False: un carattere multibyte troncato a fine campione non è un errore
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return "latin-1"
+    return "utf-8"
+
+
+def _sniff_delimiter(sample_text):
+    """Separatore del CSV (; o ,) dedotto dalle prime righe, con ; come default."""
+    try:
+        return csv.Sniffer().sniff(sample_text, delimiters=";,").delimiter
+    except csv.Error:
+        header = sample_text.split("\n", 1)[0]
+        return "," if header.count(",") > header.count(";") else ";"
+
+
+@contextlib.contextmanager
+def open_csv_attachment(attachment):
+    """
+    Apre il CSV di un allegato in streaming: encoding e separatore sono dedotti dai primi KB,
+    poi il file viene decodificato a blocchi man mano che si leggono le righe, senza copie
+    complete in memoria. Restituisce (intestazione, iteratore di (numero riga, dict) delle
+    righe non vuote).
+    """
+    attachment = attachment.sudo()
+    if attachment.store_fname:
+        binary = open(attachment._full_path(attachment.store_fname), "rb")
+    else:
+        binary = io.BytesIO(attachment.raw or b"")
+    try:
+        sample = binary.read(_SNIFF_SIZE)
+        binary.seek(0)
+        encoding = _sniff_encoding(sample)
+        sample_text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample)
+        text = io.TextIOWrapper(binary, encoding=encoding, errors="replace", newline="")
+        reader = csv.DictReader(text, delimiter=_sniff_delimiter(sample_text))
+        if not reader.fieldnames:
+            raise UserError(_("CSV senza intestazioni. Colonne: email, codice_fiscale, nome_legale, cognome_legale, data_emissione."))
+        rows = (
+            (i, row)
+            for i, row in enumerate(reader, start=2)
+            if any(v and str(v).strip() for v in (row or {}).values())
+        )
+        yield reader.fieldnames, rows
+    finally:
+        binary.close()
+
+
+class TesseraImportJob(models.Model):
+    _name = "tessera.import.job"
+    _description = "Importazione tessere in background"
+    _order = "id desc"
+
+    name = fields.Char(string="Nome", required=True)
+    associazione_id = fields.Many2one(
+        "associazione.culturale", string="Associazione", required=True
+    )
+    piano_id = fields.Many2one(
+        "piano.tesseramento", string="Piano Tesseramento", required=True
+    )
+    invia_email_conferma = fields.Boolean(string="Invia email di conferma ai soci")
+    chunk_size = fields.Integer(string="Righe per blocco", default=500)
+    attachment_id = fields.Many2one(
+        "ir.attachment", string="File CSV", required=True, ondelete="restrict"
+    )
+    state = fields.Selection(
+        [
+            ("in_attesa", "In attesa"),
+            ("in_corso", "In corso"),
+            ("completato", "Completato"),
+            ("errore", "Errore"),
+        ],
+        string="Stato",
+        default="in_attesa",
+        required=True,
+        index=True,
+    )
+    righe_totali = fields.Integer(string="Righe totali", readonly=True)
+    righe_elaborate = fields.Integer(string="Righe elaborate", readonly=True)
+    ultima_riga = fields.Integer(
+        string="Ultima riga elaborata",
+        readonly=True,
+        help="Numero di riga del file fino a cui l'import è stato salvato: dopo un riavvio riprende da qui.",
+    )
+    progresso = fields.Float(string="Avanzamento", compute="_compute_progresso")
+    tessere_create = fields.Integer(string="Tessere create", readonly=True)
+    associati_creati = fields.Integer(string="Associati creati", readonly=True)
+    righe_in_errore = fields.Integer(string="Righe in errore", readonly=True)
+    tempo_elaborazione = fields.Float(string="Tempo di elaborazione (s)", readonly=True)
+    errore_ids = fields.One2many(
+        "tessera.import.job.errore", "job_id", string="Errori", readonly=True
+    )
+    error_attachment_id = fields.Many2one(
+        "ir.attachment", string="Report errori", readonly=True, ondelete="set null"
+    )
+    stato_import = fields.Char(string="Esito", readonly=True)
+
+    @api.depends("righe_elaborate", "righe_totali", "state")
+    def _compute_progresso(self):
+        for job in self:
+            if job.state == "completato":
+                job.progresso = 100.0
+            elif job.righe_totali:
+                job.progresso = 100.0 * job.righe_elaborate / job.righe_totali
+            else:
+                job.progresso = 0.0
+
+    def _commit(self):
+        """Salva il punto raggiunto (non nei test, che girano in un'unica transazione)."""
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()
+
+    def _normalize_email(self, email):
+        return normalize_email(email)
+
+    def _normalize_cf(self, cf):
+        if not cf or not str(cf).strip():
+            return ""
+        return "".join(c for c in str(cf).upper().strip() if c.isalnum())
+
+    def _associato_vals_from_row(self, row):
+        """Valori per la creazione di un associato a partire da una riga del CSV."""
+        email = self._normalize_email(row.get("email") or row.get("Email") or "")
+        cf = self._normalize_cf(row.get("codice_fiscale") or row.get("codice fiscale") or row.get("cf") or "")
+        nome = (row.get("nome_legale") or row.get("nome") or "").strip()
+        cognome = (row.get("cognome_legale") or row.get("cognome") or "").strip()
+        vals = {"email": email, "nome_legale": nome or False, "cognome_legale": cognome or False}
+        if cf:
+            vals["codice_fiscale"] = cf
+        return vals
+
+    def _resolve_associati(self, vals_by_line, Associato):
+        """
+        Associati già esistenti per le righe di un blocco: una query per le email e una per i
+        codici fiscali (in forma canonica). Restituisce {riga: id associato}.
+        """
+        emails = list({vals["email"] for vals in vals_by_line.values() if vals["email"]})
+        by_email = {}
+        if emails:
+            # Indice su email_normalized: match esatto case-insensitive senza wildcard
+            # (email con underscore/percentuale sono valide RFC e non vanno usate in ILIKE)
+            Associato.flush_model(["email_normalized"])
+            self.env.cr.execute(SQL(
+                "SELECT email_normalized, MIN(id) FROM %s WHERE email_normalized = ANY(%s) GROUP BY email_normalized",
+                SQL.identifier(Associato._table),
+                emails,
+            ))
+            by_email = dict(self.env.cr.fetchall())
+        resolved = {}
+        cf_lines = {}
+        for line, vals in vals_by_line.items():
+            if vals["email"] in by_email:
+                resolved[line] = by_email[vals["email"]]
+            elif vals.get("codice_fiscale"):
+                cf_lines.setdefault(_cf_canonical(vals["codice_fiscale"]), []).append(line)
+        if cf_lines:
+            for associato in Associato._search_by_codice_fiscale(list(cf_lines)):
+                for line in cf_lines.get(associato.codice_fiscale_normalizzato, []):
+                    resolved[line] = associato.id
+        return resolved
+
+    def _create_in_blocco(self, Model, vals_by_line, errors):
+        """
+        Crea i record con una sola create; se il blocco fallisce riprova riga per riga,
+        ognuna nel proprio savepoint, per isolare le righe in errore. Restituisce {riga: record}.
+        """
+        lines = list(vals_by_line)
+        if not lines:
+            return {}
+        try:
+            with self.env.cr.savepoint():
+                records = Model.create([vals_by_line[line] for line in lines])
+            return dict(zip(lines, records))
+        except Exception:
+            result = {}
+            for line in lines:
+                try:
+                    with self.env.cr.savepoint():
+                        result[line] = Model.create(vals_by_line[line])
+                except Exception as e:
+                    errors.append((line, str(e)))
+            return result
+
+    def _import_chunk(self, rows, Associato, Tessera, errors):
+        """
+        Importa un blocco di righe (riga, dict CSV): valida i codici fiscali e risolve gli
+        associati esistenti in blocco, crea i mancanti con una sola create e poi tutte le
+        tessere con una sola create. Restituisce (associati creati, tessere create).
+        """
+        vals_by_line = {line: self._associato_vals_from_row(row) for line, row in rows}
+        # Validazione in blocco dei codici fiscali (una sola lettura dei comuni per blocco)
+        cf_errors = validate_codici_fiscali(self.env, vals_by_line.items())
+        associato_by_line = self._resolve_associati(vals_by_line, Associato)
+
+        # Nuovi associati, deduplicati per email e codice fiscale all'interno del blocco:
+        # new_by_line indica per ogni riga la prima riga che crea il suo associato
+        to_create = {}
+        new_by_line = {}
+        pending_by_key = {}
+        for line, vals in vals_by_line.items():
+            if line in associato_by_line:
+                continue
+            if not vals["email"]:
+                errors.append((line, _("Riga senza email né associato esistente.")))
+                continue
+            # CF già validato in blocco: non si tenta la create
+            if line in cf_errors:
+                errors.append((line, cf_errors[line]))
+                continue
+            keys = [("email", vals["email"])]
+            if vals.get("codice_fiscale"):
+                keys.append(("cf", _cf_canonical(vals["codice_fiscale"])))
+            first = next((pending_by_key[k] for k in keys if k in pending_by_key), None)
+            if first is None:
+                first = line
+                to_create[line] = vals
+                for key in keys:
+                    pending_by_key[key] = line
+            new_by_line[line] = first
+        created = self._create_in_blocco(Associato, to_create, errors)
+        for line, first in new_by_line.items():
+            if first in created:
+                associato_by_line[line] = created[first].id
+            elif first != line:
+                errors.append((line, _("Associato non creato (vedi riga %s).") % first))
+
+        tessere_vals = {}
+        for line, row in rows:
+            if line not in associato_by_line:
+                continue
+            tessere_vals[line] = {
+                "associazione_id": self.associazione_id.id,
+                "piano_id": self.piano_id.id,
+                "associato_id": associato_by_line[line],
+                "data_emissione": self._parse_date(
+                    row.get("data_emissione") or row.get("data emissione") or row.get("Data emissione") or ""
+                ),
+                "invia_email_conferma": self.invia_email_conferma,
+            }
+        tessere = self._create_in_blocco(Tessera, tessere_vals, errors)
+        return len(created), len(tessere)
+
+    def _parse_date(self, value):
+        if not value or not str(value).strip():
+            return fields.Date.today()
+        s = str(value).strip()
+        for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
+            try:
+                return datetime.strptime(s, fmt).date()
+            except ValueError:
+                continue
+        return fields.Date.today()
+
+    def _open_csv(self):
+        return open_csv_attachment(self.attachment_id)
+
+    @api.model
+    def _dry_run(self, rows, chunk_size=5000, preview_size=200):
+        """
+        Verifica le righe senza scrivere nulla: normalizza email e CF, valida i CF e risolve
+        gli associati esistenti a blocchi, riconosce i duplicati nel file (stessa email o CF)
+        con una mappa. Restituisce (conteggi, anteprima): l'anteprima è una lista di dict
+        con le righe problematiche per prime.
+        """
+        Associato = self.env["associato"].sudo()
+        counts = dict.fromkeys(("righe", "esistenti", "nuovi", "duplicati", "errori"), 0)
+        seen = {}
+        problems, others = [], []
+        rows = iter(rows)
+        chunk = list(itertools.islice(rows, chunk_size))
+        while chunk:
+            vals_by_line = {line: self._associato_vals_from_row(row) for line, row in chunk}
+            cf_errors = validate_codici_fiscali(self.env, vals_by_line.items())
+            existing = self._resolve_associati(vals_by_line, Associato)
+            for line, vals in vals_by_line.items():
+                counts["righe"] += 1
+                cf = vals.get("codice_fiscale") or ""
+                message = ""
+                if line in existing:
+                    esito = "esistente"
+                elif not vals["email"]:
+                    esito, message = "errore", _("Riga senza email né associato esistente.")
+                elif line in cf_errors:
+                    esito, message = "errore", cf_errors[line]
+                else:
+                    esito = "nuovo"
+                if esito != "errore":
+                    keys = [("email", vals["email"])] if vals["email"] else []
+                    if cf:
+                        keys.append(("cf", _cf_canonical(cf)))
+                    first = next((seen[k] for k in keys if k in seen), None)
+                    if first is None:
+                        for key in keys:
+                            seen[key] = line
+                    else:
+                        esito = "duplicato"
+                        message = _("Stesso associato della riga %s: verrà creata un'altra tessera.") % first
+                counts[{"esistente": "esistenti", "nuovo": "nuovi", "duplicato": "duplicati", "errore": "errori"}[esito]] += 1
+                entry = {
+                    "riga": line,
+                    "email": vals["email"],
+                    "codice_fiscale": cf,
+                    "esito": esito,
+                    "messaggio": message,
+                }
+                target = problems if esito in ("errore", "duplicato") else others
+                if len(target) < preview_size:
+                    target.append(entry)
+            chunk = list(itertools.islice(rows, chunk_size))
+        return counts, (problems + others)[:preview_size]
+
+    def _process(self, deadline):
+        """
+        Elabora il job a blocchi a partire da ``ultima_riga``, salvando avanzamento ed errori
+        dopo ogni blocco. Restituisce False se il tempo a disposizione è finito prima della fine.
+        """
+        self.ensure_one()
+        try:
+            if self.state == "in_attesa":
+                with self._open_csv() as (header, rows):
+                    righe_totali = sum(1 for _row in rows)
+                self.write({"state": "in_corso", "righe_totali": righe_totali})
+            with self._open_csv() as (header, rows):
+                return self._process_rows(header, rows, deadline)
+        except UserError as e:
+            self.write({"state": "errore", "stato_import": str(e)})
+            return True
+
+    def _process_rows(self, header, rows, deadline):
+        """Importa le righe successive a ``ultima_riga`` leggendone un blocco alla volta."""
+        Associato = self.env["associato"].sudo()
+        # Nessun tracciamento per tessera: un solo riepilogo sull'associazione a fine job
+        Tessera = self.env["tessera"].sudo().with_context(**BULK_CREATE_CONTEXT)
+        chunk_size = max(self.chunk_size or 0, 1)
+        ultima_riga = self.ultima_riga
+        todo = (row for row in rows if row[0] > ultima_riga)
+        chunk = list(itertools.islice(todo, chunk_size))
+        while chunk:
+            started = time.perf_counter()
+            errors = []
+            try:
+                with self.env.cr.savepoint():
+                    n_associati, n_tessere = self._import_chunk(chunk, Associato, Tessera, errors)
+            except Exception as e:
+                _logger.exception("Import tessere %s: errore nel blocco dalla riga %s", self.id, chunk[0][0])
+                self.write({
+                    "state": "errore",
+                    "stato_import": _("Errore imprevisto dalla riga %s: %s") % (chunk[0][0], e),
+                })
+                self._commit()
+                return True
+            rows_by_line = dict(chunk)
+            self.env["tessera.import.job.errore"].create([
+                {
+                    "job_id": self.id,
+                    "riga": line,
+                    "messaggio": message,
+                    "valori": json.dumps(rows_by_line.get(line) or {}, ensure_ascii=False),
+                }
+                for line, message in errors
+            ])
+            self.write({
+                "ultima_riga": chunk[-1][0],
+                "righe_elaborate": self.righe_elaborate + len(chunk),
+                "associati_creati": self.associati_creati + n_associati,
+                "tessere_create": self.tessere_create + n_tessere,
+                "righe_in_errore": self.righe_in_errore + len({line for line, _msg in errors}),
+                "tempo_elaborazione": self.tempo_elaborazione + time.perf_counter() - started,
+            })
+            # Ogni blocco importato resta salvato anche se un blocco successivo fallisce
+            self._commit()
+            chunk = list(itertools.islice(todo, chunk_size))
+            if chunk and time.monotonic() > deadline:
+                return False
+        self._finish(header)
+        self._commit()
+        return True
+
+    def _finish(self, header):
+        """Chiude il job: esito riassuntivo e report CSV completo delle righe in errore."""
+        rate = self.righe_elaborate / self.tempo_elaborazione if self.tempo_elaborazione else self.righe_elaborate
+        _logger.info(
+            "Import tessere %s: %s righe in %.2fs (%.0f righe/s), %s tessere, %s nuovi associati, %s errori",
+            self.id, self.righe_elaborate, self.tempo_elaborazione, rate,
+            self.tessere_create, self.associati_creati, self.righe_in_errore,
+        )
+        errori = self.errore_ids.sorted("riga")
+        if errori:
+            out = io.StringIO()
+            writer = csv.writer(out, delimiter=";")
+            writer.writerow(["riga", "errore"] + list(header))
+            for errore in errori:
+                valori = json.loads(errore.valori or "{}")
+                writer.writerow([errore.riga, errore.messaggio] + [valori.get(col) or "" for col in header])
+            self.error_attachment_id = self.env["ir.attachment"].create({
+                "name": _("errori_import_%s.csv") % self.id,
+                "raw": out.getvalue().encode("utf-8-sig"),
+                "mimetype": "text/csv",
+                "res_model": self._name,
+                "res_id": self.id,
+            })
+            messages = ["Riga %s: %s" % (e.riga, e.messaggio) for e in errori[:15]]
+            stato = _("Importate %s tessere, %s nuovi associati. Errori: ") % (self.tessere_create, self.associati_creati) + "; ".join(messages)
+        else:
+            stato = _("Importate %s tessere. Creati %s nuovi associati.") % (self.tessere_create, self.associati_creati)
+        self.write({
+            "state": "completato",
+            "stato_import": stato + _(" (%s righe/s)") % int(rate),
+        })
+        self.env["tessera"]._log_creazione_in_blocco(
+            self.associazione_id, self.tessere_create, _("import %s") % self.name
+        )
+
+    @api.model
+    def _cron_process_import_jobs(self):
+        """Cron: elabora i job di import in attesa o interrotti, riprendendo dall'ultima riga salvata."""
+        deadline = time.monotonic() + _JOB_TIME_BUDGET
+        for job in self.search([("state", "in", ("in_attesa", "in_corso"))], order="id"):
+            if not job._process(deadline):
+                # Tempo esaurito: il cron riparte subito e riprende dal punto salvato
+                self.env.ref("associazioni_culturali.ir_cron_tessera_import_job")._trigger()
+                return
+
+    def action_download_errori(self):
+        self.ensure_one()
+        if not self.error_attachment_id:
+            raise UserError(_("Nessun report errori disponibile."))
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % self.error_attachment_id.id,
+            "target": "self",
+        }
+
+    def action_riprova(self):
+        """Rimette in coda un job in errore, riprendendo dall'ultima riga salvata."""
+        self.filtered(lambda j: j.state == "errore").write({"state": "in_corso"})
+        self.env.ref("associazioni_culturali.ir_cron_tessera_import_job")._trigger()
+        return True
+
+
+class TesseraImportJobErrore(models.Model):
+    _name = "tessera.import.job.errore"
+    _description = "Errore di riga di un import tessere"
+    _order = "job_id, riga"
+
+    job_id = fields.Many2one(
+        "tessera.import.job", string="Import", required=True, ondelete="cascade", index=True
+    )
+    riga = fields.Integer(string="Riga")
+    messaggio = fields.Char(string="Errore")
+    valori = fields.Text(string="Valori della riga (JSON)")
@@ -1,8 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import time
+
+from psycopg2.errors import SerializationFailure
+
 from odoo import models, fields, api, _
+from odoo.tools import SQL, mute_logger
+from odoo.tools.sql import index_exists
 from datetime import datetime, timedelta
 
+from .tessera import archivia_in_blocchi
+
+_logger = logging.getLogger(__name__)
+
+# Prefisso dei riferimenti delle transazioni di pagamento del tesseramento (TESS-<id>,
+# TESS-RINN-<id>): riconosce le transazioni del modulo senza interrogare il database
+TESSERAMENTO_REFERENCE_PREFIX = 'TESS-'
+# Giorni dopo i quali i tesseramenti completati/annullati vengono archiviati (0 = disattivata)
+ARCHIVIO_PENDING_GIORNI_PARAM = 'associazioni_culturali.archivio_pending_giorni'
+ARCHIVIO_PENDING_GIORNI_DEFAULT = 180
+# Giorni dopo i quali un tesseramento non pagato viene annullato
+PENDING_SCADENZA_GIORNI_PARAM = 'associazioni_culturali.pending_scadenza_giorni'
+PENDING_SCADENZA_GIORNI_DEFAULT = 30
+# Giorni dopo i quali i tesseramenti annullati vengono eliminati (0 = mai)
+PENDING_CONSERVAZIONE_GIORNI_PARAM = 'associazioni_culturali.pending_conservazione_giorni'
+PENDING_CONSERVAZIONE_GIORNI_DEFAULT = 365
+# Righe per statement (e per commit, fuori dai test) del cron di pulizia
+_PULIZIA_BATCH_SIZE = 1000
+
 
 class TesseramentoPending(models.Model):
     _name = 'tesseramento.pending'
@@ -16,7 +42,8 @@ class TesseramentoPending(models.Model):
     importo = fields.Monetary(string='Importo', required=True, currency_field='currency_id')
     currency_id = fields.Many2one('res.currency', string='Valuta', 
                                    default=lambda self: self.env.company.currency_id)
-    transaction_id = fields.Many2one('payment.transaction', string='Transazione Pagamento', ondelete='set null')
+    transaction_id = fields.Many2one('payment.transaction', string='Transazione Pagamento', ondelete='set null',
+                                     index='btree_not_null')
     tessera_id = fields.Many2one('tessera', string='Tessera Creata', readonly=True)
     stato = fields.Selection([
         ('pending', 'In Attesa di Pagamento'),
@@ -26,6 +53,18 @@ class TesseramentoPending(models.Model):
     ], string='Stato', default='pending')
     note = fields.Text(string='Note')
     create_date = fields.Datetime(string='Data Creazione', readonly=True)
+    active = fields.Boolean(string='Attivo', default=True)
+
+    def init(self):
+        # Indici parziali sui soli record non archiviati (regole portale, cron dei pending scaduti)
+        indexes = {
+            'tesseramento_pending_associato_active_idx': '(associato_id) WHERE active',
+            'tesseramento_pending_in_attesa_idx': "(create_date) WHERE active AND stato = 'pending'",
+            'tesseramento_pending_annullati_idx': "(create_date) WHERE stato = 'cancelled'",
+        }
+        for indexname, definition in indexes.items():
+            if not index_exists(self.env.cr, indexname):
+                self.env.cr.execute(f'CREATE INDEX {indexname} ON tesseramento_pending {definition}')
 
     @api.depends('associato_id', 'associazione_id', 'piano_id', 'create_date')
     def _compute_name(self):
@@ -36,39 +75,197 @@ class TesseramentoPending(models.Model):
             else:
                 record.name = 'Nuovo Tesseramento'
 
+    def _blocca_per_completamento(self, stati):
+        """
+        Blocca i pending ancora senza tessera negli ``stati`` indicati con
+        SELECT ... FOR UPDATE SKIP LOCKED e restituisce quelli ottenuti. Un pending che un
+        altro worker sta completando (ritorno dal provider e webhook in parallelo) viene
+        saltato senza attendere il lock.
+        Odoo lavora in REPEATABLE READ: se l'altra transazione ha già fatto commit dopo
+        l'inizio di questa, il lock fallisce con un errore di serializzazione. L'errore resta
+        confinato in un savepoint e il pending viene saltato, perché è già stato completato.
+        """
+        if not self.ids:
+            return self.browse()
+        self.flush_recordset(['stato', 'tessera_id'])
+        try:
+            bloccati = self._select_for_update_skip_locked(self.ids, stati)
+        except SerializationFailure:
+            # Riprova pending per pending per isolare quelli completati da altri
+            bloccati = []
+            for pending_id in self.ids:
+                try:
+                    bloccati += self._select_for_update_skip_locked([pending_id], stati)
+                except SerializationFailure:
+                    _logger.info("Tesseramento pending %s completato da un'altra transazione", pending_id)
+        bloccati = self.browse(bloccati)
+        bloccati.invalidate_recordset(['stato', 'tessera_id'])
+        return bloccati
+
+    def _select_for_update_skip_locked(self, ids, stati):
+        with mute_logger('odoo.sql_db'), self.env.cr.savepoint():
+            self.env.cr.execute(SQL(
+                """
+                SELECT id FROM tesseramento_pending
+                 WHERE id IN %s AND stato IN %s AND tessera_id IS NULL
+                   FOR UPDATE SKIP LOCKED
+                """,
+                tuple(ids),
+                tuple(stati),
+            ))
+            return [row[0] for row in self.env.cr.fetchall()]
+
+    def _completa_pagamento(self):
+        """Pagamento confermato: segna i pending come pagati e crea le tessere (idempotente)."""
+        bloccati = self._blocca_per_completamento(('pending', 'paid'))
+        bloccati.write({'stato': 'paid'})
+        return bloccati.action_completa_tessera()
+
     def action_completa_tessera(self):
-        """Completa la creazione della tessera dopo il pagamento"""
-        for record in self:
-            if record.stato == 'paid' and not record.tessera_id:
-                tessera = self.env['tessera'].create({
-                    'associato_id': record.associato_id.id,
-                    'piano_id': record.piano_id.id,
-                    'associazione_id': record.associazione_id.id,
-                    'importo_pagato': record.importo,
-                    'note': record.note,
-                    'invia_email_conferma': False,  # inviamo noi dopo, per avere tessera completa
-                })
-                record.write({
-                    'tessera_id': tessera.id,
-                    'stato': 'completed',
-                })
-                # Invia email di conferma dopo la creazione (tessera completa e committata)
-                if tessera.associato_id.email:
-                    tessera._send_email_conferma_tessera()
-                return tessera
-        return False
+        """
+        Completa la creazione della tessera dopo il pagamento. Restituisce le tessere create:
+        vuoto se i pending non sono pagati, sono già completati o li sta completando un'altra
+        transazione. Il vincolo univoco su tessera.tesseramento_pending_id garantisce al più
+        una tessera per pending.
+        """
+        tessere = self.env['tessera']
+        for record in self._blocca_per_completamento(('paid',)):
+            tessera = self.env['tessera'].create({
+                'associato_id': record.associato_id.id,
+                'piano_id': record.piano_id.id,
+                'associazione_id': record.associazione_id.id,
+                'importo_pagato': record.importo,
+                'note': record.note,
+                'tesseramento_pending_id': record.id,
+                'invia_email_conferma': False,  # inviamo noi dopo, per avere tessera completa
+            })
+            record.write({
+                'tessera_id': tessera.id,
+                'stato': 'completed',
+            })
+            tessere |= tessera
+        # Email di conferma accodate dopo la creazione (tessere complete): il callback
+        # di pagamento non attende l'SMTP
+        tessere._send_email_conferma_tessera()
+        return tessere
+
+    def _get_giorni_param(self, param, default):
+        return int(self.env['ir.config_parameter'].sudo().get_param(param, default) or 0)
+
+    def _commit_blocco(self):
+        """Transazioni brevi per ogni blocco (non nei test, che girano in un'unica transazione)."""
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()
+
+    @api.model
+    def _cron_annulla_pending_scaduti(self, batch_size=_PULIZIA_BATCH_SIZE):
+        """
+        Pulizia dei tesseramenti abbandonati, a blocchi di ``batch_size`` righe:
+        annulla i pending più vecchi del limite configurato (e le relative transazioni di
+        pagamento ancora in bozza), poi elimina gli annullati oltre il periodo di
+        conservazione, compresi quelli già archiviati da _cron_archivia_storico (consultabili
+        tra gli archiviati fino ad allora). Registra righe coinvolte e durata dell'esecuzione.
+        """
+        started = time.perf_counter()
+        cr = self.env.cr
+        self.flush_model()
+        annullati = transazioni = eliminati = 0
+
+        giorni = self._get_giorni_param(PENDING_SCADENZA_GIORNI_PARAM, PENDING_SCADENZA_GIORNI_DEFAULT)
+        if giorni > 0:
+            limite = datetime.now() - timedelta(days=giorni)
+            while True:
+                cr.execute(SQL(
+                    """
+                    UPDATE tesseramento_pending
+                       SET stato = 'cancelled', write_uid = %(uid)s, write_date = now() at time zone 'UTC'
+                     WHERE id IN (
+                            SELECT id FROM tesseramento_pending
+                             WHERE active AND stato = 'pending' AND create_date < %(limite)s
+                             LIMIT %(limit)s
+                               FOR UPDATE SKIP LOCKED
+                           )
+                 RETURNING transaction_id
+                    """,
+                    uid=self.env.uid,
+                    limite=limite,
+                    limit=batch_size,
+                ))
+                rows = cr.fetchall()
+                annullati += len(rows)
+                tx_ids = [row[0] for row in rows if row[0]]
+                if tx_ids:
+                    bozze = self.env['payment.transaction'].sudo().search([
+                        ('id', 'in', tx_ids), ('state', '=', 'draft'),
+                    ])
+                    bozze._set_canceled()
+                    transazioni += len(bozze)
+                self._commit_blocco()
+                if len(rows) < batch_size:
+                    break
+            self.invalidate_model(['stato', 'write_uid', 'write_date'])
+
+        giorni = self._get_giorni_param(
+            PENDING_CONSERVAZIONE_GIORNI_PARAM, PENDING_CONSERVAZIONE_GIORNI_DEFAULT
+        )
+        if giorni > 0:
+            limite = datetime.now() - timedelta(days=giorni)
+            while True:
+                cr.execute(SQL(
+                    """
+                    DELETE FROM tesseramento_pending
+                     WHERE id IN (
+                            SELECT id FROM tesseramento_pending
+                             WHERE stato = 'cancelled' AND create_date < %(limite)s
+                             LIMIT %(limit)s
+                               FOR UPDATE SKIP LOCKED
+                           )
+                    """,
+                    limite=limite,
+                    limit=batch_size,
+                ))
+                eliminati += cr.rowcount
+                self._commit_blocco()
+                if cr.rowcount < batch_size:
+                    break
+            self.invalidate_model()
+
+        run = self.env['tesseramento.pending.pulizia'].create({
+            'pending_annullati': annullati,
+            'transazioni_annullate': transazioni,
+            'pending_eliminati': eliminati,
+            'durata': time.perf_counter() - started,
+        })
+        _logger.info(
+            "Pulizia tesseramenti pending: %s annullati, %s transazioni annullate, %s eliminati in %.2fs",
+            annullati, transazioni, eliminati, run.durata,
+        )
+        return run
 
     @api.model
-    def _cron_annulla_pending_scaduti(self):
-        """Cron job per annullare tesseramenti pending vecchi (> 30 giorni)"""
-        cutoff_date = datetime.now() - timedelta(days=30)
-        pending_scaduti = self.search([
-            ('stato', '=', 'pending'),
-            ('create_date', '<', cutoff_date),
-        ])
-        
-        if pending_scaduti:
-            pending_scaduti.write({'stato': 'cancelled'})
-            import logging
-            _logger = logging.getLogger(__name__)
-            _logger.info(f"Annullati {len(pending_scaduti)} tesseramenti pending scaduti")
+    def _cron_archivia_storico(self):
+        """Archivia i tesseramenti completati o annullati più vecchi dei giorni configurati"""
+        giorni = int(
+            self.env['ir.config_parameter'].sudo().get_param(
+                ARCHIVIO_PENDING_GIORNI_PARAM, ARCHIVIO_PENDING_GIORNI_DEFAULT
+            ) or 0
+        )
+        if giorni <= 0:
+            return 0
+        limite = datetime.now() - timedelta(days=giorni)
+        count = archivia_in_blocchi(
+            self, SQL("stato IN ('completed', 'cancelled') AND create_date < %s", limite)
+        )
+        _logger.info("Archiviati %s tesseramenti pending precedenti al %s", count, limite)
+        return count
+
+
+class TesseramentoPendingPulizia(models.Model):
+    _name = 'tesseramento.pending.pulizia'
+    _description = 'Esecuzione pulizia tesseramenti pending'
+    _order = 'id desc'
+
+    pending_annullati = fields.Integer(string='Pending annullati', readonly=True)
+    transazioni_annullate = fields.Integer(string='Transazioni annullate', readonly=True)
+    pending_eliminati = fields.Integer(string='Pending eliminati', readonly=True)
+    durata = fields.Float(string='Durata (s)', readonly=True)
@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 
-# from . import report_model
+from . import tessera_statistiche
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from odoo import _, api, fields, models, tools
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+
+class TesseraStatistiche(models.Model):
+    """
+    Statistiche del tesseramento per associazione, piano, anno di emissione e stato.
+    Basata su una vista materializzata: grafici e pivot leggono poche righe aggregate invece
+    dell'intera tabella delle tessere. I dati sono aggiornati dal cron (REFRESH CONCURRENTLY,
+    senza bloccare le letture) o su richiesta dal pulsante "Aggiorna".
+    """
+
+    _name = "tessera.statistiche"
+    _description = "Statistiche tesseramento"
+    _auto = False
+    _order = "anno desc, associazione_id, piano_id"
+
+    associazione_id = fields.Many2one(
+        "associazione.culturale", string="Associazione", readonly=True
+    )
+    piano_id = fields.Many2one(
+        "piano.tesseramento", string="Piano Tesseramento", readonly=True
+    )
+    anno = fields.Integer(string="Anno", readonly=True, aggregator=False)
+    stato = fields.Selection(
+        [
+            ("attiva", "Attiva"),
+            ("scaduta", "Scaduta"),
+            ("annullata", "Annullata"),
+        ],
+        string="Stato",
+        readonly=True,
+    )
+    currency_id = fields.Many2one("res.currency", string="Valuta", readonly=True)
+    numero_tessere = fields.Integer(string="Tessere", readonly=True)
+    numero_associati = fields.Integer(
+        string="Associati",
+        readonly=True,
+        aggregator=False,
+        help="Associati distinti nel gruppo: non sommabile tra gruppi diversi.",
+    )
+    importo_pagato = fields.Monetary(
+        string="Importo Pagato", currency_field="currency_id", readonly=True
+    )
+
+    def _query(self):
+        # Id stabile tra un refresh e l'altro: derivato (hash a 60 bit) dalle colonne di
+        # raggruppamento, così la stessa riga mantiene lo stesso id nei pivot aperti.
+        # Chiavi di raggruppamento mai NULL (currency_key per la valuta opzionale): l'indice
+        # univoco richiesto da REFRESH ... CONCURRENTLY le confronta come valori normali
+        return """
+            SELECT ('x' || substr(md5(format('%s-%s-%s-%s-%s',
+                       t.associazione_id, t.piano_id, EXTRACT(YEAR FROM t.data_emissione),
+                       COALESCE(t.stato, 'attiva'), COALESCE(t.currency_id, 0))), 1, 15))::bit(60)::bigint AS id,
+                   t.associazione_id,
+                   t.piano_id,
+                   EXTRACT(YEAR FROM t.data_emissione)::integer AS anno,
+                   COALESCE(t.stato, 'attiva') AS stato,
+                   t.currency_id,
+                   COALESCE(t.currency_id, 0) AS currency_key,
+                   count(*) AS numero_tessere,
+                   count(DISTINCT t.associato_id) AS numero_associati,
+                   COALESCE(sum(t.importo_pagato), 0) AS importo_pagato
+              FROM tessera t
+          GROUP BY t.associazione_id, t.piano_id, EXTRACT(YEAR FROM t.data_emissione),
+                   COALESCE(t.stato, 'attiva'), t.currency_id
+        """
+
+    def init(self):
+        # Ricreata a ogni aggiornamento del modulo: la definizione può cambiare tra versioni
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(f"CREATE MATERIALIZED VIEW {self._table} AS ({self._query()})")
+        # Chiave univoca sulle colonne di raggruppamento, richiesta da REFRESH ... CONCURRENTLY
+        self.env.cr.execute(
+            f"CREATE UNIQUE INDEX {self._table}_gruppo_idx ON {self._table}"
+            " (associazione_id, piano_id, anno, stato, currency_key)"
+        )
+        self.env.cr.execute(f"CREATE INDEX {self._table}_id_idx ON {self._table} (id)")
+
+    @api.model
+    def _refresh(self, concurrently=True):
+        """Ricalcola la vista materializzata; con ``concurrently`` le letture non sono bloccate."""
+        started = time.perf_counter()
+        self.env["tessera"].flush_model()
+        self.env.cr.execute(SQL(
+            "REFRESH MATERIALIZED VIEW %s %s",
+            SQL("CONCURRENTLY") if concurrently else SQL(),
+            SQL.identifier(self._table),
+        ))
+        self.invalidate_model()
+        _logger.info("Statistiche tesseramento aggiornate in %.2fs", time.perf_counter() - started)
+
+    @api.model
+    def _cron_refresh(self):
+        self._refresh()
+
+    def action_aggiorna(self):
+        """Aggiorna le statistiche su richiesta e ricarica la vista."""
+        self._refresh()
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Statistiche aggiornate"),
+                "message": _("Le statistiche del tesseramento sono state ricalcolate."),
+                "type": "success",
+                "sticky": False,
+                "next": {"type": "ir.actions.client", "tag": "soft_reload"},
+            },
+        }
@@ -0,0 +1,52 @@
+import { onMounted, onWillUnmount } from "@odoo/owl";
+import { registry } from "@web/core/registry";
+import {
+    ProgressBarField,
+    progressBarField,
+} from "@web/views/fields/progress_bar/progress_bar_field";
+
+// Stati del job di import in cui l'avanzamento può ancora cambiare
+const STATI_ATTIVI = ["in_attesa", "in_corso"];
+
+/**
+ * Barra di avanzamento di un import tessere: finché il job è in attesa o in corso ricarica
+ * periodicamente il record, così l'avanzamento si aggiorna senza interventi dell'utente.
+ */
+export class TesseraImportProgressBarField extends ProgressBarField {
+    static props = {
+        ...ProgressBarField.props,
+        stateField: { type: String },
+        interval: { type: Number },
+    };
+
+    setup() {
+        super.setup();
+        onMounted(() => {
+            this.timer = setInterval(() => this.aggiorna(), this.props.interval);
+        });
+        onWillUnmount(() => clearInterval(this.timer));
+    }
+
+    async aggiorna() {
+        const record = this.props.record;
+        if (!STATI_ATTIVI.includes(record.data[this.props.stateField]) || record.dirty) {
+            return;
+        }
+        await record.load();
+    }
+}
+
+export const tesseraImportProgressBarField = {
+    ...progressBarField,
+    component: TesseraImportProgressBarField,
+    extractProps(fieldInfo, dynamicInfo) {
+        const { options } = fieldInfo;
+        return {
+            ...progressBarField.extractProps(fieldInfo, dynamicInfo),
+            stateField: options.state_field || "state",
+            interval: (options.interval || 3) * 1000,
+        };
+    },
+};
+
+registry.category("fields").add("tessera_import_progressbar", tesseraImportProgressBarField);
@@ -6,4 +6,7 @@ from . import test_tessera
 from . import test_tessera_import_wizard
 from . import test_piano_tesseramento
 from . import test_associazione_culturale
-from . import test_tesseramento_pending
\ No newline at end of file
+from . import test_tesseramento_pending
+from . import test_codice_fiscale_benchmark
+from . import test_res_comune
+from . import test_tessera_statistiche
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from psycopg2 import IntegrityError
+
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import ValidationError, UserError
+from odoo.tools import mute_logger
 from datetime import date, timedelta
 
+from odoo.addons.associazioni_culturali.models.associato import validate_codici_fiscali
+
 
 class TestAssociato(TransactionCase):
 
@@ -74,7 +79,6 @@ class TestAssociato(TransactionCase):
             'data_emissione': date.today(),
             'stato': 'attiva',
         })
-        self.associato._compute_tessera_attuale()
         self.assertEqual(self.associato.tessera_attuale_id, tessera_attiva)
         self.assertFalse(self.associato.tessera_in_scadenza)
 
@@ -88,10 +92,55 @@ class TestAssociato(TransactionCase):
             'data_scadenza': date.today() + timedelta(days=15),
             'stato': 'attiva',
         })
-        self.associato._compute_tessera_attuale()
         self.assertEqual(self.associato.tessera_attuale_id, tessera)
         self.assertTrue(self.associato.tessera_in_scadenza)
 
+    def test_tessera_attuale_memorizzata(self):
+        """Tessera attuale aggiornata all'annullamento e cercabile"""
+        tessera = self.Tessera.create({
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+            'data_emissione': date.today(),
+        })
+        self.assertEqual(self.associato.tessera_attuale_id, tessera)
+        self.assertEqual(self.associato.tessera_attuale_scadenza, tessera.data_scadenza)
+        self.assertIn(self.associato, self.Associato.search([('tessera_attuale_id', '!=', False)]))
+        tessera.action_annulla()
+        self.assertFalse(self.associato.tessera_attuale_id)
+        self.assertFalse(self.associato.tessera_attuale_scadenza)
+        self.assertNotIn(self.associato, self.Associato.search([('tessera_attuale_id', '!=', False)]))
+
+    def test_tessera_attuale_cron(self):
+        """Il cron delle scadenze aggiorna la tessera attuale memorizzata"""
+        tessera = self.Tessera.create({
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+            'data_emissione': date.today(),
+        })
+        self.assertFalse(self.associato.tessera_in_scadenza)
+        # Simula il passare del tempo: la scadenza entra nel periodo "in scadenza"
+        scadenza = date.today() + timedelta(days=10)
+        self.env.flush_all()
+        self.env.cr.execute("UPDATE tessera SET data_scadenza = %s WHERE id = %s", [scadenza, tessera.id])
+        self.env.cr.execute(
+            "UPDATE associato SET tessera_attuale_scadenza = %s WHERE id = %s", [scadenza, self.associato.id]
+        )
+        self.env.invalidate_all()
+        self.Tessera._cron_aggiorna_stati()
+        self.assertEqual(self.associato.tessera_attuale_id, tessera)
+        self.assertTrue(self.associato.tessera_in_scadenza)
+        # ... e poi la supera
+        self.env.cr.execute(
+            "UPDATE tessera SET data_scadenza = %s WHERE id = %s", [date.today() - timedelta(days=1), tessera.id]
+        )
+        self.env.invalidate_all()
+        self.Tessera._cron_aggiorna_stati()
+        self.assertEqual(tessera.stato, 'scaduta')
+        self.assertFalse(self.associato.tessera_attuale_id)
+        self.assertFalse(self.associato.tessera_in_scadenza)
+
     def test_get_tessere_passate(self):
         """Recupero tessere passate"""
         tessera_scaduta = self.Tessera.create({
@@ -144,10 +193,10 @@ class TestAssociato(TransactionCase):
         """Codice fiscale italiano valido (carattere di controllo corretto)"""
         a = self.Associato.create({
             'email': 'cf@test.com',
-            'codice_fiscale': 'RSSMRA80A01H501U',
+            'codice_fiscale': 'RSSMRA80A01F205X',
             'country_id': self.env.ref('base.it').id,
         })
-        self.assertEqual(a.codice_fiscale, 'RSSMRA80A01H501U')
+        self.assertEqual(a.codice_fiscale, 'RSSMRA80A01F205X')
 
     def test_codice_fiscale_validation_invalid(self):
         """Codice fiscale non valido"""
@@ -221,10 +270,10 @@ class TestAssociato(TransactionCase):
         """Se nome/cognome legale sono vuoti, il match viene saltato e il CF valido è accettato"""
         a = self.Associato.create({
             'email': 'solo@test.com',
-            'codice_fiscale': 'RSSMRA80A01H501U',
+            'codice_fiscale': 'RSSMRA80A41H501Y',
             'country_id': self.env.ref('base.it').id,
         })
-        self.assertEqual(a.codice_fiscale, 'RSSMRA80A01H501U')
+        self.assertEqual(a.codice_fiscale, 'RSSMRA80A41H501Y')
 
     def test_codice_fiscale_to_birth_date_19xx(self):
         """_codice_fiscale_to_birth_date: due cifre 30-99 -> 19XX (1980, 1930)"""
@@ -265,6 +314,82 @@ class TestAssociato(TransactionCase):
         self.assertEqual(a.codice_fiscale, 'RSSMRA03A01H501F')
         self.assertEqual(a.data_nascita, date(2003, 1, 1))
 
+    def test_codice_fiscale_normalizzato(self):
+        """Il CF canonico rimuove l'omocodia e ricalcola il carattere di controllo"""
+        self.assertEqual(self.associato.codice_fiscale_normalizzato, 'RSSMRA80A01H501U')
+        omocodico = self.Associato.create({
+            'email': 'omocodico@test.com',
+            'codice_fiscale': 'bnc gpp 75c12 f205u',
+        })
+        self.assertEqual(omocodico.codice_fiscale_normalizzato, 'BNCGPP75C12F205U')
+        senza_cf = self.Associato.create({
+            'email': 'senzacf@test.com',
+            'no_codice_fiscale': True,
+        })
+        self.assertFalse(senza_cf.codice_fiscale_normalizzato)
+
+    def test_codice_fiscale_omocodico_duplicato(self):
+        """Un CF omocodico equivalente a uno esistente viene rifiutato"""
+        with self.assertRaises(ValidationError):
+            self.Associato.create({
+                'email': 'omocodia@test.com',
+                'codice_fiscale': 'RSSMRA80A01H50MM',  # omocodia di RSSMRA80A01H501U
+            })
+
+    def test_codice_fiscale_indice_univoco(self):
+        """Il database rifiuta un CF canonico duplicato anche senza passare dal vincolo Python"""
+        altro = self.Associato.create({
+            'email': 'indice.cf@test.com',
+            'no_codice_fiscale': True,
+        })
+        self.env.flush_all()
+        with mute_logger('odoo.sql_db'), self.assertRaises(IntegrityError), self.env.cr.savepoint():
+            self.env.cr.execute(
+                "UPDATE associato SET codice_fiscale_normalizzato = %s WHERE id = %s",
+                (self.associato.codice_fiscale_normalizzato, altro.id),
+            )
+
+    def test_search_by_codice_fiscale(self):
+        """Ricerca per CF in forma canonica: trova l'associato anche con variante omocodica"""
+        self.assertEqual(
+            self.Associato._search_by_codice_fiscale(['RSSMRAU0A01H501R']),
+            self.associato,
+        )
+        self.assertFalse(self.Associato._search_by_codice_fiscale(['']))
+
+    def test_calcola_codice_fiscale(self):
+        """Generazione del CF atteso dai dati anagrafici, per sesso"""
+        roma = self.env['res.comune'].search([('codice_catastale', '=', 'H501')], limit=1) or \
+            self.env['res.comune'].create({'name': 'Roma', 'codice_catastale': 'H501', 'provincia': 'RM'})
+        codici = self.Associato._calcola_codice_fiscale('Mario', 'Rossi', date(1980, 1, 1), roma.id)
+        self.assertEqual(codici['M'], 'RSSMRA80A01H501U')
+        self.assertEqual(codici['F'], 'RSSMRA80A41H501Y')
+        self.assertEqual(
+            self.Associato._calcola_codice_fiscale('Mario', 'Rossi', date(1980, 1, 1), roma.id, sesso='M'),
+            {'M': 'RSSMRA80A01H501U'},
+        )
+        self.assertEqual(self.Associato._calcola_codice_fiscale('', 'Rossi', date(1980, 1, 1), roma.id), {})
+
+    def test_validate_codici_fiscali_batch(self):
+        """Validazione in blocco: errori restituiti per chiave, solo per le voci non valide"""
+        errors = validate_codici_fiscali(self.env, [
+            ('ok', {'codice_fiscale': 'RSSMRA80A01H501U', 'data_nascita': date(1980, 1, 1)}),
+            ('controllo', {'codice_fiscale': 'RSSMRA80A01H501X'}),
+            ('cognome', {'codice_fiscale': 'RSSMRA80A01H501U', 'cognome_legale': 'Bianchi'}),
+            ('vuoto', {'codice_fiscale': ''}),
+            ('senza_cf', {'no_codice_fiscale': True}),
+        ])
+        self.assertEqual(set(errors), {'controllo', 'cognome', 'vuoto'})
+        self.assertIn('carattere di controllo', errors['controllo'])
+
+    def test_validate_codici_fiscali_recordset(self):
+        """Validazione in blocco sul recordset: nessun errore per associati validi"""
+        altro = self.Associato.create({
+            'email': 'altro@test.com',
+            'no_codice_fiscale': True,
+        })
+        self.assertEqual((self.associato | altro)._validate_codici_fiscali(), {})
+
     def test_action_reclama(self):
         """Reclamo profilo: utente con stessa email può associare"""
         associato_senza_user = self.Associato.create({
@@ -290,3 +415,27 @@ class TestAssociato(TransactionCase):
         with self.assertRaises(UserError):
             associato.with_user(other_user).action_reclama()
         self.assertFalse(associato.user_id)
+
+    def test_email_normalized(self):
+        """Email normalizzata (spazi rimossi, minuscolo) mantenuta su create e write e usata per le ricerche"""
+        associato = self.Associato.create({
+            'email': '  Mario.Rossi@Example.COM ',
+            'no_codice_fiscale': True,
+        })
+        self.assertEqual(associato.email_normalized, 'mario.rossi@example.com')
+        self.assertEqual(
+            self.Associato.search([('email_normalized', '=', 'mario.rossi@example.com')]),
+            associato,
+        )
+        associato.email = 'Nuova@Example.com'
+        self.assertEqual(associato.email_normalized, 'nuova@example.com')
+
+    def test_action_reclama_email_maiuscole(self):
+        """Reclamo profilo: il confronto delle email non dipende da maiuscole e spazi"""
+        associato = self.Associato.create({
+            'email': ' TEST@Example.com',
+            'user_id': False,
+            'no_codice_fiscale': True,
+        })
+        associato.with_user(self.user).action_reclama()
+        self.assertEqual(associato.user_id, self.user)
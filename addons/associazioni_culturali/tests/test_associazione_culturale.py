@@ -129,3 +129,30 @@ class TestAssociazioneCulturale(TransactionCase):
         self.assertEqual(associazione.sito_web, 'https://www.test.it')
         self.assertEqual(associazione.data_costituzione, date(2020, 1, 1))
         self.assertEqual(associazione.note, 'Note di test')
+
+    def test_tesseramento_form_options_cache(self):
+        """Opzioni del form pubblico in cache, invalidate alla modifica di associazioni e piani"""
+        associazione = self.Associazione.create({
+            'name': 'Associazione Form Pubblico',
+            'company_id': self.company.id,
+        })
+        website_id = self.env['website'].search([], limit=1).id
+        options = self.Associazione._get_tesseramento_form_options(website_id, 'en_US')
+        self.assertIn(associazione.id, [a.id for a in options['associazioni']])
+        # Chiamata ripetuta: stesso risultato dalla cache
+        self.assertIs(self.Associazione._get_tesseramento_form_options(website_id, 'en_US'), options)
+        # Campi non mostrati nel form: la cache resta valida
+        associazione.note = 'Nota interna'
+        self.assertIs(self.Associazione._get_tesseramento_form_options(website_id, 'en_US'), options)
+
+        associazione.consenti_registrazione_pubblica = False
+        options = self.Associazione._get_tesseramento_form_options(website_id, 'en_US')
+        self.assertNotIn(associazione.id, [a.id for a in options['associazioni']])
+
+        piano = self.Piano.create({
+            'name': 'Piano Form Pubblico',
+            'tipo': 'calendario',
+            'costo_tessera': 15.0,
+        })
+        options = self.Associazione._get_tesseramento_form_options(website_id, 'en_US')
+        self.assertIn(piano.id, [p.id for p in options['piani']])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from datetime import date, timedelta
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.associazioni_culturali.models.associato import (
+    _cf_compute,
+    validate_codici_fiscali,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged("-standard", "benchmark")
+class TestCodiceFiscaleBenchmark(TransactionCase):
+    """
+    Costo per record della validazione in blocco dei codici fiscali e della verifica
+    (dry-run) di un file di import.
+    Escluso dai test standard: eseguire con ``--test-tags benchmark``.
+    """
+
+    def _entries(self, count, comune):
+        start = date(1940, 1, 1)
+        for i in range(count):
+            nascita = start + timedelta(days=i % 20000)
+            cf = _cf_compute(
+                "Mario", "Rossi", nascita, "M", comune.codice_catastale if comune else "H501"
+            )
+            yield i, {
+                "codice_fiscale": cf,
+                "data_nascita": nascita,
+                "nome_legale": "Mario",
+                "cognome_legale": "Rossi",
+                "comune_nascita_id": comune.id if comune else False,
+            }
+
+    def test_benchmark_validate_codici_fiscali(self):
+        comune = self.env["res.comune"].search([("codice_catastale", "=", "H501")], limit=1)
+        for count in (1000, 10000, 100000):
+            entries = list(self._entries(count, comune))
+            started = time.perf_counter()
+            errors = validate_codici_fiscali(self.env, entries)
+            elapsed = time.perf_counter() - started
+            self.assertFalse(errors)
+            _logger.info(
+                "validate_codici_fiscali: %s record in %.3fs (%.2f µs/record)",
+                count,
+                elapsed,
+                elapsed / count * 1e6,
+            )
+
+    def test_benchmark_dry_run_import(self):
+        comune = self.env["res.comune"].search([("codice_catastale", "=", "H501")], limit=1)
+        count = 50000
+        rows = (
+            (i + 2, {
+                "email": "socio%s@example.com" % i,
+                "codice_fiscale": vals["codice_fiscale"],
+                "nome_legale": "Mario",
+                "cognome_legale": "Rossi",
+            })
+            for i, vals in self._entries(count, comune)
+        )
+        started = time.perf_counter()
+        counts, preview = self.env["tessera.import.job"]._dry_run(rows)
+        elapsed = time.perf_counter() - started
+        self.assertEqual(counts["righe"], count)
+        _logger.info(
+            "Verifica import: %s righe in %.3fs (%.2f µs/riga)",
+            count,
+            elapsed,
+            elapsed / count * 1e6,
+        )
@@ -128,3 +128,53 @@ class TestPianoTesseramento(TransactionCase):
         
         # Dovrebbe avere l'anno corrente
         self.assertEqual(piano.anno_riferimento, date.today().year)
+
+    def test_payment_provider_preferito_e_cache(self):
+        """Provider del piano: preferito se abilitato, altrimenti risolto (in cache) per valuta"""
+        piano = self.Piano.create({
+            'name': 'Piano Provider',
+            'tipo': 'calendario',
+            'costo_tessera': 10.0,
+        })
+        provider = self.env['payment.provider'].create({
+            'name': 'Provider Tesseramento',
+            'code': 'none',
+            'state': 'enabled',
+            'is_published': True,
+            'company_id': self.env.company.id,
+        })
+        piano.provider_id = provider
+        self.assertEqual(piano._get_payment_provider(self.env.company), provider)
+        # Preferito non pubblicato o senza la valuta del piano: ignorato come nel fallback
+        provider.is_published = False
+        self.assertNotEqual(piano._get_payment_provider(self.env.company), provider)
+        altra_valuta = self.env['res.currency'].with_context(active_test=False).search(
+            [('id', '!=', piano.currency_id.id)], limit=1
+        )
+        provider.write({'is_published': True, 'available_currency_ids': [(6, 0, altra_valuta.ids)]})
+        self.assertNotEqual(piano._get_payment_provider(self.env.company), provider)
+        provider.available_currency_ids = False
+        self.assertEqual(piano._get_payment_provider(self.env.company), provider)
+        # Disattivazione: la cache del resolver viene invalidata e il preferito ignorato
+        provider.write({'state': 'disabled'})
+        self.assertNotEqual(piano._get_payment_provider(self.env.company), provider)
+        self.assertNotEqual(
+            self.env['payment.provider']._get_tesseramento_provider_id(self.env.company.id, piano.currency_id.id),
+            provider.id,
+        )
+
+    def test_payment_provider_ordine_sequenza(self):
+        """Riordinare i provider invalida la cache: vince il primo per sequenza"""
+        Provider = self.env['payment.provider']
+        vals = {
+            'code': 'none',
+            'state': 'enabled',
+            'is_published': True,
+            'company_id': self.env.company.id,
+        }
+        primo = Provider.create(dict(vals, name='Provider Primo', sequence=-20))
+        secondo = Provider.create(dict(vals, name='Provider Secondo', sequence=-10))
+        currency_id = self.env.company.currency_id.id
+        self.assertEqual(Provider._get_tesseramento_provider_id(self.env.company.id, currency_id), primo.id)
+        secondo.sequence = -30
+        self.assertEqual(Provider._get_tesseramento_provider_id(self.env.company.id, currency_id), secondo.id)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.associazioni_culturali.models.res_comune import COMUNI_CSV_HASH_PARAM
+
+
+class TestResComune(TransactionCase):
+
+    def setUp(self):
+        super(TestResComune, self).setUp()
+        self.Comune = self.env['res.comune']
+        self.comune = self.Comune.create({
+            'name': 'Zzforlì',
+            'codice_catastale': 'Y901',
+            'provincia': 'FC',
+        })
+        self.comune_prefisso = self.Comune.create({
+            'name': 'Zzforlimpopoli',
+            'codice_catastale': 'Y902',
+            'provincia': 'FC',
+        })
+        self.comune_sottostringa = self.Comune.create({
+            'name': 'Borgo Zzforlì',
+            'codice_catastale': 'Y903',
+            'provincia': 'RN',
+        })
+
+    def test_search_index_senza_accenti(self):
+        """Autocomplete dall'indice in memoria: accenti ignorati, esatto prima del prefisso"""
+        results = self.Comune._search_comuni_index('zzforli')
+        ids = [r['id'] for r in results]
+        self.assertEqual(ids[:2], [self.comune.id, self.comune_prefisso.id])
+        self.assertEqual(results[0]['text'], 'Zzforlì (FC)')
+
+    def test_search_index_sottostringa_dopo_prefisso(self):
+        """Le sottostringhe seguono i prefissi"""
+        ids = [r['id'] for r in self.Comune._search_comuni_index('zzforl')]
+        self.assertLess(ids.index(self.comune_prefisso.id), ids.index(self.comune_sottostringa.id))
+
+    def test_search_index_codice_catastale(self):
+        """Ricerca per codice catastale"""
+        results = self.Comune._search_comuni_index('y902')
+        self.assertEqual(results[0]['id'], self.comune_prefisso.id)
+
+    def test_search_index_invalidato_alla_modifica(self):
+        """L'indice viene ricostruito dopo la modifica dei comuni"""
+        self.Comune._search_comuni_index('zzforli')
+        self.comune.write({'name': 'Zzcesena'})
+        ids = [r['id'] for r in self.Comune._search_comuni_index('zzcesena')]
+        self.assertEqual(ids, [self.comune.id])
+
+    def test_name_search_senza_accenti(self):
+        """name_search del backend: accenti ignorati, nome esatto prima dei prefissi"""
+        results = self.Comune.name_search('Zzforli')
+        ids = [r[0] for r in results]
+        self.assertEqual(ids[:2], [self.comune.id, self.comune_prefisso.id])
+        self.assertIn(self.comune_sottostringa.id, ids)
+        self.assertEqual(results[0][1], 'Zzforlì (FC)')
+
+    def test_name_search_codice_catastale(self):
+        """name_search per codice catastale esatto"""
+        results = self.Comune.name_search('y903')
+        self.assertEqual(results[0][0], self.comune_sottostringa.id)
+
+    def test_snapshot_versionato(self):
+        """Lo snapshot statico cambia versione solo quando cambiano i comuni"""
+        version, payload, compressed = self.Comune._get_comuni_snapshot()
+        self.assertIn('Zzforlì (FC)', payload.decode())
+        self.assertEqual(gzip.decompress(compressed), payload)
+        self.assertEqual(self.Comune._get_comuni_snapshot()[0], version)
+        self.assertEqual(self.Comune._get_comuni_snapshot_url(), '/tesseramento/comuni/%s.json' % version)
+        self.comune_prefisso.write({'provincia': 'RA'})
+        self.assertNotEqual(self.Comune._get_comuni_snapshot()[0], version)
+
+    def test_load_comuni_csv(self):
+        """Il caricamento in blocco ripristina i comuni del file e si salta se l'hash non cambia"""
+        aglie = self.env.ref('associazioni_culturali.comune_A074')
+        self.assertEqual(aglie.codice_catastale, 'A074')
+        self.assertFalse(self.Comune._load_comuni_csv())
+
+        self.env.cr.execute("UPDATE res_comune SET name = 'Modificato' WHERE id = %s", [aglie.id])
+        self.env['ir.config_parameter'].sudo().set_param(COMUNI_CSV_HASH_PARAM, False)
+        self.assertTrue(self.Comune._load_comuni_csv())
+        self.assertEqual(aglie.name, 'Agliè')
+        self.assertEqual(aglie.name_search_key, 'aglie')
+        # I comuni creati fuori dal file non vengono toccati
+        self.assertTrue(self.comune.active)
+
+    def test_comune_soppresso_risolvibile(self):
+        """Un comune soppresso (archiviato) resta risolvibile per il codice fiscale"""
+        self.comune.active = False
+        self.assertEqual(self.Comune._get_comune_cf_data(self.comune.id), ('Zzforlì', 'Y901'))
+        self.assertNotIn(self.comune.id, [r['id'] for r in self.Comune._search_comuni_index('zzforli')])
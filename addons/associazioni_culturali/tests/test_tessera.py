@@ -51,6 +51,13 @@ class TestTessera(TransactionCase):
             'email': 'test@example.com',
         })
 
+        # Crea un associato
+        self.associato = self.Associato.create({
+            'email': 'test@example.com',
+            'user_id': self.user.id,
+            'no_codice_fiscale': True,
+        })
+
     def test_tessera_creation(self):
         """Test creazione tessera base"""
         tessera = self.Tessera.create({
@@ -76,11 +83,10 @@ class TestTessera(TransactionCase):
             'data_emissione': date(2024, 1, 15),
         })
         
-        # Il nome dovrebbe essere nel formato: ASSOCIAZIONE-USER-ANNO-NUMERO
+        # Il nome dovrebbe essere nel formato: ASSOCIAZIONE-ANNO-NUMERO
         self.assertTrue(tessera.name)
-        self.assertIn('TEST', tessera.name.upper())
-        self.assertIn(str(self.associato.id), tessera.name)
-        self.assertIn('2024', tessera.name)
+        self.assertIn('TES', tessera.name.upper())
+        self.assertIn('-2024-', tessera.name)
 
     def test_tessera_name_compute_calendario(self):
         """Test calcolo nome tessera per piano calendario"""
@@ -92,8 +98,24 @@ class TestTessera(TransactionCase):
         })
         
         self.assertTrue(tessera.name)
-        self.assertIn('TEST', tessera.name.upper())
-        self.assertIn(str(self.associato.id), tessera.name)
+        self.assertIn('TES', tessera.name.upper())
+        self.assertIn('-%s-' % date.today().year, tessera.name)
+
+    def test_tessera_numerazione_progressiva(self):
+        """Numeri progressivi senza buchi per associazione e anno, anche con creazione in blocco"""
+        vals = {
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+        }
+        tessere = self.Tessera.create([
+            dict(vals, data_emissione=date(2030, 1, 1)),
+            dict(vals, data_emissione=date(2030, 6, 1)),
+            dict(vals, data_emissione=date(2031, 1, 1)),
+        ])
+        self.assertEqual(tessere.mapped('name'), ['TES-2030-00001', 'TES-2030-00002', 'TES-2031-00001'])
+        altra = self.Tessera.create(dict(vals, data_emissione=date(2030, 12, 31)))
+        self.assertEqual(altra.name, 'TES-2030-00003')
 
     def test_data_scadenza_annuale_solare(self):
         """Test calcolo data scadenza per piano annuale solare"""
@@ -221,9 +243,124 @@ class TestTessera(TransactionCase):
             'stato': 'attiva',
         })
         
+        # Lo stato salvato è calcolato alla scrittura: forza "attiva" come una tessera non ancora aggiornata
+        self.env.cr.execute("UPDATE tessera SET stato = 'attiva' WHERE id = %s", [tessera.id])
+        tessera.invalidate_recordset()
+
         # Esegui il cron
-        self.Tessera._cron_aggiorna_stati()
+        run = self.Tessera._cron_aggiorna_stati()
         
         # Ricarica la tessera
         tessera.invalidate_recordset()
         self.assertEqual(tessera.stato, 'scaduta')
+        self.assertGreaterEqual(run.tessere_scadute, 1)
+        self.assertIn('Scaduta', tessera.message_ids[0].body)
+
+        # Una seconda esecuzione non trova altre transizioni per questa tessera
+        messaggi = len(tessera.message_ids)
+        self.Tessera._cron_aggiorna_stati()
+        tessera.invalidate_recordset()
+        self.assertEqual(len(tessera.message_ids), messaggi)
+
+    def test_cron_archivia_storico(self):
+        """Archiviazione delle tessere scadute oltre l'orizzonte configurato"""
+        self.env['ir.config_parameter'].sudo().set_param('associazioni_culturali.archivio_tessere_anni', 2)
+        vals = {
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+            'invia_email_conferma': False,
+        }
+        storica = self.Tessera.create(dict(vals, data_emissione=date.today() - timedelta(days=365 * 4)))
+        recente = self.Tessera.create(dict(vals, data_emissione=date.today() - timedelta(days=400)))
+        attiva = self.Tessera.create(dict(vals, data_emissione=date.today()))
+
+        self.Tessera._cron_archivia_storico()
+
+        self.assertFalse(storica.active)
+        self.assertTrue(recente.active)
+        self.assertTrue(attiva.active)
+        self.assertNotIn(storica, self.associato.tessere_ids)
+        self.assertIn(storica, self.associato.tessere_archiviate_ids)
+        self.assertIn(storica, self.associato.get_tessere_passate())
+
+    def test_crea_in_blocco_senza_tracciamento(self):
+        """Creazione massiva: nessun messaggio per tessera, un riepilogo sull'associazione"""
+        associati = self.Associato.create([
+            {'email': 'blocco%s@example.com' % i, 'no_codice_fiscale': True} for i in range(3)
+        ])
+        messaggi_associazione = len(self.associazione.message_ids)
+        tessere = self.Tessera._crea_in_blocco([
+            {
+                'associato_id': associato.id,
+                'piano_id': self.piano_calendario.id,
+                'associazione_id': self.associazione.id,
+                'invia_email_conferma': False,
+            }
+            for associato in associati
+        ], 'test')
+        self.assertEqual(len(tessere), 3)
+        self.assertFalse(tessere.message_ids)
+        self.assertFalse(tessere.message_follower_ids)
+        self.assertEqual(len(self.associazione.message_ids), messaggi_associazione + 1)
+        self.assertIn('3 tessere create in blocco', self.associazione.message_ids[0].body)
+
+    def test_rinnova_in_blocco(self):
+        """Rinnovo massivo: solo tessere scadute o in scadenza, per associazione, senza importo"""
+        altra_associazione = self.Associazione.create({
+            'name': 'Altra Associazione',
+            'company_id': self.company.id,
+        })
+        scaduta = self.Tessera.create({
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+            'data_emissione': date.today() - timedelta(days=370),
+            'importo_pagato': 60.0,
+            'invia_email_conferma': False,
+        })
+        in_scadenza = self.Tessera.create({
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': altra_associazione.id,
+            'data_emissione': date.today() - timedelta(days=350),
+            'invia_email_conferma': False,
+        })
+        self.assertEqual(scaduta.stato, 'scaduta')
+        (scaduta | in_scadenza).action_rinnova_in_blocco()
+
+        nuova = self.associato.tessere_ids.filtered(
+            lambda t: t.associazione_id == self.associazione and t != scaduta
+        )
+        self.assertEqual(len(nuova), 1)
+        self.assertEqual(nuova.data_emissione, date.today())
+        self.assertFalse(nuova.importo_pagato)
+        # La tessera dell'altra associazione è rinnovata anche se il socio ne ha una attuale
+        rinnovo = self.associato.tessere_ids.filtered(
+            lambda t: t.associazione_id == altra_associazione and t != in_scadenza
+        )
+        self.assertEqual(len(rinnovo), 1)
+        self.assertEqual(rinnovo.data_emissione, in_scadenza.data_scadenza + timedelta(days=1))
+
+        # Seconda esecuzione: già rinnovate; le nuove tessere non sono in scadenza
+        (scaduta | in_scadenza | nuova | rinnovo).action_rinnova_in_blocco()
+        self.assertEqual(len(self.associato.tessere_ids), 4)
+
+    def test_email_conferma_accodate(self):
+        """Email di conferma accodate (non inviate) a blocchi, distribuite nel tempo se c'è un limite al minuto"""
+        self.env['ir.config_parameter'].sudo().set_param(
+            'associazioni_culturali.email_conferma_per_minuto', 2
+        )
+        tessere = self.Tessera.create([{
+            'associato_id': self.associato.id,
+            'piano_id': self.piano_calendario.id,
+            'associazione_id': self.associazione.id,
+            'invia_email_conferma': True,
+        } for _i in range(3)])
+        mails = self.env['mail.mail'].search([
+            ('model', '=', 'tessera'),
+            ('res_id', 'in', tessere.ids),
+        ])
+        self.assertEqual(len(mails), 3)
+        self.assertEqual(set(mails.mapped('state')), {'outgoing'})
+        self.assertEqual(len(set(mails.mapped('scheduled_date'))), 2)
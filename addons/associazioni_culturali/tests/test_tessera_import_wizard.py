@@ -48,6 +48,11 @@ class TestTesseraImportWizard(TransactionCase):
             writer.writerow(row)
         return base64.b64encode(out.getvalue().encode("utf-8"))
 
+    def _run_import(self, wizard):
+        """Avvia l'import e lo elabora subito come farebbe il cron."""
+        wizard.action_import()
+        self.env["tessera.import.job"]._cron_process_import_jobs()
+
     def test_import_finds_associato_with_underscore_email(self):
         """Import con email contenente underscore trova l'associato esistente (nessun duplicato)."""
         associato = self.Associato.create({
@@ -70,7 +75,7 @@ class TestTesseraImportWizard(TransactionCase):
             "data_file": csv_data,
             "filename": "test.csv",
         })
-        wizard.action_import()
+        self._run_import(wizard)
         self.assertIn("0 nuovi associati", wizard.stato_import)
         tessere = self.Tessera.search([
             ("associato_id", "=", associato.id),
@@ -108,7 +113,7 @@ class TestTesseraImportWizard(TransactionCase):
             "data_file": csv_data,
             "filename": "test.csv",
         })
-        wizard.action_import()
+        self._run_import(wizard)
         tessere_underscore = self.Tessera.search([
             ("associato_id", "=", associato_underscore.id),
             ("associazione_id", "=", self.associazione.id),
@@ -119,3 +124,162 @@ class TestTesseraImportWizard(TransactionCase):
         ])
         self.assertEqual(len(tessere_underscore), 1)
         self.assertEqual(len(tessere_no_underscore), 0)
+
+    def test_import_cf_non_valido_non_crea_associato(self):
+        """Riga con CF non valido: errore di riga, nessun associato creato"""
+        csv_data = self._make_csv([{
+            "email": "cf_errato@test.com",
+            "codice_fiscale": "RSSMRA80A01H501X",
+            "nome_legale": "Mario",
+            "cognome_legale": "Rossi",
+            "data_emissione": "01/01/2024",
+        }])
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": csv_data,
+            "filename": "test.csv",
+        })
+        self._run_import(wizard)
+        self.assertIn("Riga 2", wizard.stato_import)
+        self.assertFalse(self.Associato.search([("email", "=", "cf_errato@test.com")]))
+
+    def test_import_trova_associato_per_cf_omocodico(self):
+        """Import senza email corrispondente: l'associato viene trovato per CF anche se omocodico"""
+        associato = self.Associato.create({
+            "email": "mario.rossi@test.com",
+            "codice_fiscale": "RSSMRA80A01H501U",
+            "country_id": self.env.ref("base.it").id,
+        })
+        csv_data = self._make_csv([{
+            "email": "altra.email@test.com",
+            "codice_fiscale": "RSSMRA80A01H50MM",
+            "nome_legale": "",
+            "cognome_legale": "",
+            "data_emissione": "01/01/2024",
+        }])
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": csv_data,
+            "filename": "test.csv",
+        })
+        self._run_import(wizard)
+        self.assertEqual(
+            self.Tessera.search([("associazione_id", "=", self.associazione.id)]).associato_id,
+            associato,
+        )
+
+    def test_import_in_blocchi(self):
+        """Import a blocchi: associati deduplicati nel file, righe in errore isolate"""
+        esistente = self.Associato.create({
+            "email": "esistente@test.com",
+            "no_codice_fiscale": True,
+            "country_id": self.env.ref("base.it").id,
+        })
+        csv_data = self._make_csv([
+            {"email": "Esistente@Test.com", "codice_fiscale": "", "nome_legale": "", "cognome_legale": "", "data_emissione": ""},
+            {"email": "nuovo@test.com", "codice_fiscale": "RSSMRA80A01H501U", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": ""},
+            {"email": "", "codice_fiscale": "", "nome_legale": "Senza", "cognome_legale": "Email", "data_emissione": ""},
+            {"email": "nuovo@test.com", "codice_fiscale": "RSSMRA80A01H501U", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": "01/02/2024"},
+            {"email": "altro@test.com", "codice_fiscale": "RSSMRA80A41H501Y", "nome_legale": "Maria", "cognome_legale": "Rossi", "data_emissione": ""},
+        ])
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": csv_data,
+            "filename": "test.csv",
+            "chunk_size": 2,
+        })
+        self._run_import(wizard)
+        self.assertIn("Importate 4 tessere, 2 nuovi associati", wizard.stato_import)
+        self.assertIn("Riga 4", wizard.stato_import)
+        self.assertIn("righe/s", wizard.stato_import)
+        tessere = self.Tessera.search([("associazione_id", "=", self.associazione.id)])
+        self.assertEqual(len(tessere.filtered(lambda t: t.associato_id == esistente)), 1)
+        self.assertEqual(len(self.Associato.search([("email", "=", "nuovo@test.com")])), 1)
+
+    def test_import_job_ripresa_e_report_errori(self):
+        """Il job si ferma a tempo scaduto, riprende dall'ultima riga salvata e produce il report errori"""
+        csv_data = self._make_csv([
+            {"email": "uno@test.com", "codice_fiscale": "RSSMRA80A01H501U", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": ""},
+            {"email": "", "codice_fiscale": "", "nome_legale": "Senza", "cognome_legale": "Email", "data_emissione": ""},
+            {"email": "due@test.com", "codice_fiscale": "RSSMRA80A41H501Y", "nome_legale": "Maria", "cognome_legale": "Rossi", "data_emissione": ""},
+        ])
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": csv_data,
+            "filename": "test.csv",
+            "chunk_size": 1,
+        })
+        wizard.action_import()
+        job = wizard.job_id
+        self.assertEqual(job.state, "in_attesa")
+
+        # Tempo già scaduto: viene elaborato un solo blocco
+        self.assertFalse(job._process(deadline=0))
+        self.assertEqual(job.state, "in_corso")
+        self.assertEqual(job.ultima_riga, 2)
+        self.assertEqual(job.righe_totali, 3)
+        self.assertEqual(job.tessere_create, 1)
+
+        self.assertTrue(job._process(deadline=float("inf")))
+        self.assertEqual(job.state, "completato")
+        self.assertEqual(wizard.job_progresso, 100.0)
+        self.assertEqual(job.tessere_create, 2)
+        self.assertEqual(job.righe_in_errore, 1)
+        self.assertEqual(job.errore_ids.riga, 3)
+        report = job.error_attachment_id.raw.decode("utf-8-sig")
+        self.assertIn("riga;errore;email", report)
+        self.assertIn("3;", report)
+        self.assertIn("Senza", report)
+
+    def test_import_csv_latin1_con_virgola(self):
+        """Encoding e separatore vengono dedotti dal file: Latin-1 con separatore virgola"""
+        content = (
+            "email,codice_fiscale,nome_legale,cognome_legale,data_emissione\n"
+            "nicolo@test.com,RSSMRA80A01H501U,Nicolò,Rossi,01/01/2024\n"
+        ).encode("latin-1")
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": base64.b64encode(content),
+            "filename": "test.csv",
+        })
+        self._run_import(wizard)
+        self.assertIn("Creati 1 nuovi associati", wizard.stato_import)
+        associato = self.Associato.search([("email", "=", "nicolo@test.com")])
+        self.assertEqual(associato.nome_legale, "Nicolò")
+        self.assertEqual(wizard.job_id.attachment_id.res_model, "tessera.import.job")
+
+    def test_verifica_senza_importare(self):
+        """La verifica conta esistenti, nuovi, duplicati ed errori senza creare nulla"""
+        self.Associato.create({
+            "email": "esistente@test.com",
+            "no_codice_fiscale": True,
+            "country_id": self.env.ref("base.it").id,
+        })
+        csv_data = self._make_csv([
+            {"email": "esistente@test.com", "codice_fiscale": "", "nome_legale": "", "cognome_legale": "", "data_emissione": ""},
+            {"email": "nuovo@test.com", "codice_fiscale": "RSSMRA80A01H501U", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": ""},
+            {"email": "altra@test.com", "codice_fiscale": "RSSMRA80A01H50MM", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": ""},
+            {"email": "", "codice_fiscale": "", "nome_legale": "Senza", "cognome_legale": "Email", "data_emissione": ""},
+            {"email": "cf_errato@test.com", "codice_fiscale": "RSSMRA80A01H501X", "nome_legale": "Mario", "cognome_legale": "Rossi", "data_emissione": ""},
+        ])
+        wizard = self.Wizard.create({
+            "associazione_id": self.associazione.id,
+            "piano_id": self.piano.id,
+            "data_file": csv_data,
+            "filename": "test.csv",
+        })
+        wizard.action_verifica()
+        self.assertEqual(wizard.verifica_righe, 5)
+        self.assertEqual(wizard.verifica_esistenti, 1)
+        self.assertEqual(wizard.verifica_nuovi, 1)
+        self.assertEqual(wizard.verifica_duplicati, 1)
+        self.assertEqual(wizard.verifica_errori, 2)
+        self.assertIn("cf_errato@test.com", wizard.verifica_anteprima)
+        self.assertFalse(wizard.job_id)
+        self.assertFalse(self.Associato.search([("email", "in", ("nuovo@test.com", "altra@test.com"))]))
+        self.assertFalse(self.Tessera.search([("associazione_id", "=", self.associazione.id)]))
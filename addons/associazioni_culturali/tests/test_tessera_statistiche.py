@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date
+
+from odoo.tests.common import TransactionCase
+
+
+class TestTesseraStatistiche(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Statistiche = self.env['tessera.statistiche']
+        self.associazione = self.env['associazione.culturale'].create({
+            'name': 'Associazione Statistiche',
+            'company_id': self.env['res.partner'].create({'name': 'Company', 'is_company': True}).id,
+            'attivo': True,
+        })
+        self.piano = self.env['piano.tesseramento'].create({
+            'name': 'Piano Calendario',
+            'tipo': 'calendario',
+            'costo_tessera': 30.0,
+            'attivo': True,
+        })
+        associati = self.env['associato'].create([
+            {'email': 'stat%s@example.com' % i, 'no_codice_fiscale': True} for i in range(3)
+        ])
+        self.tessere = self.env['tessera'].create([
+            {
+                'associato_id': associato.id,
+                'piano_id': self.piano.id,
+                'associazione_id': self.associazione.id,
+                'data_emissione': date.today(),
+                'importo_pagato': 30.0,
+                'invia_email_conferma': False,
+            }
+            for associato in associati
+        ])
+
+    def _righe(self):
+        return self.Statistiche.search([
+            ('associazione_id', '=', self.associazione.id),
+            ('anno', '=', date.today().year),
+        ])
+
+    def test_refresh(self):
+        """La vista materializzata riflette le tessere dopo l'aggiornamento"""
+        self.Statistiche._refresh(concurrently=False)
+        righe = self._righe()
+        self.assertEqual(righe.mapped('stato'), ['attiva'])
+        self.assertEqual(righe.numero_tessere, 3)
+        self.assertEqual(righe.numero_associati, 3)
+        self.assertEqual(righe.importo_pagato, 90.0)
+
+    def test_refresh_concurrently(self):
+        """L'aggiornamento concorrente ricalcola i gruppi per stato"""
+        self.Statistiche._refresh()
+        self.tessere[0].action_annulla()
+        self.Statistiche.action_aggiorna()
+        per_stato = {riga.stato: riga.numero_tessere for riga in self._righe()}
+        self.assertEqual(per_stato, {'attiva': 2, 'annullata': 1})
+
+    def test_id_stabile(self):
+        """Gli id delle righe non cambiano tra un aggiornamento e l'altro"""
+        self.Statistiche._refresh()
+        riga = self._righe()
+        self.tessere[0].action_annulla()
+        self.Statistiche._refresh()
+        self.assertIn(riga.id, self._righe().ids)
+        self.assertEqual(self.Statistiche.browse(riga.id).stato, 'attiva')
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from psycopg2 import IntegrityError
+
 from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
 from datetime import date, datetime, timedelta
 from unittest.mock import patch
 
@@ -47,7 +50,8 @@ class TestTesseramentoPending(TransactionCase):
         })
         self.associato = self.Associato.create({
             'email': 'test@example.com',
-            'associato_id': self.associato.id,
+            'user_id': self.user.id,
+            'no_codice_fiscale': True,
         })
 
     def test_tesseramento_pending_creation(self):
@@ -139,6 +143,43 @@ class TestTesseramentoPending(TransactionCase):
         self.assertEqual(pending.tessera_id, tessera1)
         self.assertEqual(pending.stato, 'completed')
 
+    def test_completa_pagamento_idempotente(self):
+        """Pagamento confermato: una sola tessera per pending anche con chiamate ripetute"""
+        pending = self.TesseramentoPending.create({
+            'associato_id': self.associato.id,
+            'associazione_id': self.associazione.id,
+            'piano_id': self.piano.id,
+            'importo': 50.0,
+            'stato': 'pending',
+        })
+        tessera = pending._completa_pagamento()
+        self.assertEqual(len(tessera), 1)
+        self.assertEqual(tessera.tesseramento_pending_id, pending)
+        self.assertEqual(pending.stato, 'completed')
+        self.assertFalse(pending._completa_pagamento())
+        self.assertEqual(self.Tessera.search_count([('tesseramento_pending_id', '=', pending.id)]), 1)
+
+    def test_tessera_unica_per_pending(self):
+        """Il vincolo univoco impedisce una seconda tessera per lo stesso pending"""
+        pending = self.TesseramentoPending.create({
+            'associato_id': self.associato.id,
+            'associazione_id': self.associazione.id,
+            'piano_id': self.piano.id,
+            'importo': 50.0,
+            'stato': 'paid',
+        })
+        tessera = pending.action_completa_tessera()
+        with mute_logger('odoo.sql_db'), self.assertRaises(IntegrityError):
+            with self.env.cr.savepoint():
+                self.Tessera.create({
+                    'associato_id': self.associato.id,
+                    'associazione_id': self.associazione.id,
+                    'piano_id': self.piano.id,
+                    'tesseramento_pending_id': pending.id,
+                    'invia_email_conferma': False,
+                })
+        self.assertEqual(pending.tessera_id, tessera)
+
     def test_send_email_conferma(self):
         """Test invio email di conferma quando tessera viene creata"""
         pending = self.TesseramentoPending.create({
@@ -198,3 +239,83 @@ class TestTesseramentoPending(TransactionCase):
         self.assertEqual(pending_old.stato, 'cancelled')
         # Verifica che pending_recente non sia stato toccato
         self.assertEqual(pending_recente.stato, 'pending')
+
+    def test_cron_pulizia_elimina_annullati(self):
+        """Annullamento a blocchi ed eliminazione degli annullati oltre la conservazione"""
+        vals = {
+            'associato_id': self.associato.id,
+            'associazione_id': self.associazione.id,
+            'piano_id': self.piano.id,
+            'importo': 50.0,
+        }
+        abbandonati = self.TesseramentoPending.create([dict(vals, stato='pending') for _i in range(3)])
+        da_eliminare = self.TesseramentoPending.create(dict(vals, stato='cancelled'))
+        archiviato = self.TesseramentoPending.create(dict(vals, stato='cancelled', active=False))
+        self.env.cr.execute(
+            "UPDATE tesseramento_pending SET create_date = %s WHERE id IN %s",
+            (datetime.now() - timedelta(days=40), tuple(abbandonati.ids)),
+        )
+        self.env.cr.execute(
+            "UPDATE tesseramento_pending SET create_date = %s WHERE id IN %s",
+            (datetime.now() - timedelta(days=400), (da_eliminare.id, archiviato.id)),
+        )
+        self.TesseramentoPending.invalidate_model()
+
+        run = self.TesseramentoPending._cron_annulla_pending_scaduti(batch_size=2)
+
+        self.assertEqual(abbandonati.mapped('stato'), ['cancelled'] * 3)
+        self.assertFalse(da_eliminare.exists())
+        # Eliminati anche gli annullati già archiviati
+        self.assertFalse(archiviato.exists())
+        self.assertGreaterEqual(run.pending_annullati, 3)
+        self.assertGreaterEqual(run.pending_eliminati, 1)
+
+    def test_cron_archivia_storico(self):
+        """Archiviazione dei tesseramenti completati/annullati vecchi"""
+        vals = {
+            'associato_id': self.associato.id,
+            'associazione_id': self.associazione.id,
+            'piano_id': self.piano.id,
+            'importo': 50.0,
+        }
+        vecchio = self.TesseramentoPending.create(dict(vals, stato='cancelled'))
+        recente = self.TesseramentoPending.create(dict(vals, stato='cancelled'))
+        in_attesa = self.TesseramentoPending.create(dict(vals, stato='pending'))
+        self.env.cr.execute(
+            "UPDATE tesseramento_pending SET create_date = %s WHERE id IN %s",
+            (datetime.now() - timedelta(days=400), (vecchio.id, in_attesa.id)),
+        )
+        self.TesseramentoPending.invalidate_model()
+
+        self.TesseramentoPending._cron_archivia_storico()
+
+        self.assertFalse(vecchio.active)
+        self.assertTrue(recente.active)
+        self.assertTrue(in_attesa.active)
+        self.assertNotIn(vecchio, self.TesseramentoPending.search([('associato_id', '=', self.associato.id)]))
+
+    def test_cron_archivia_poi_elimina_annullati(self):
+        """Con i parametri predefiniti un annullato vecchio viene archiviato e poi eliminato"""
+        ICP = self.env['ir.config_parameter'].sudo()
+        for param in ('associazioni_culturali.archivio_pending_giorni',
+                      'associazioni_culturali.pending_conservazione_giorni'):
+            ICP.search([('key', '=', param)]).unlink()
+        annullato = self.TesseramentoPending.create({
+            'associato_id': self.associato.id,
+            'associazione_id': self.associazione.id,
+            'piano_id': self.piano.id,
+            'importo': 50.0,
+            'stato': 'cancelled',
+        })
+        self.env.cr.execute(
+            "UPDATE tesseramento_pending SET create_date = %s WHERE id = %s",
+            (datetime.now() - timedelta(days=400), annullato.id),
+        )
+        self.TesseramentoPending.invalidate_model()
+
+        self.TesseramentoPending._cron_archivia_storico()
+        self.assertFalse(annullato.active)
+        run = self.TesseramentoPending._cron_annulla_pending_scaduti()
+
+        self.assertFalse(annullato.exists())
+        self.assertGreaterEqual(run.pending_eliminati, 1)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import base64
-import csv
-import io
-from datetime import datetime
+import logging
+import time
 
 from odoo import _, fields, models
-from odoo.exceptions import UserError, ValidationError
+from odoo.exceptions import UserError
+
+from ..models.tessera_import_job import open_csv_attachment
+
+_logger = logging.getLogger(__name__)
 
 
 class TesseraImportWizard(models.TransientModel):
@@ -25,113 +27,108 @@ class TesseraImportWizard(models.TransientModel):
         required=True,
         domain=[("attivo", "=", True)],
     )
-    data_file = fields.Binary(string="File CSV", required=True, attachment=False)
+    # Salvato come allegato (filestore): il job lo legge in streaming senza copie in memoria
+    # Obbligatorio solo prima dell'avvio (vedi vista): dopo, l'allegato appartiene al job
+    data_file = fields.Binary(string="File CSV", attachment=True)
     filename = fields.Char(string="Nome file")
     invia_email_conferma = fields.Boolean(
         string="Invia email di conferma ai soci",
         default=False,
     )
-    stato_import = fields.Char(string="Esito", readonly=True)
-
-    def _normalize_email(self, email):
-        return (email or "").strip().lower() if email else ""
-
-    def _normalize_cf(self, cf):
-        if not cf or not str(cf).strip():
-            return ""
-        return "".join(c for c in str(cf).upper().strip() if c.isalnum())
-
-    def _escape_ilike(self, value):
-        """Escape % and _ for use in ilike so they are not treated as wildcards."""
-        if not value:
-            return ""
-        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    chunk_size = fields.Integer(
+        string="Righe per blocco",
+        default=500,
+        help="Righe importate e salvate per volta: un errore in un blocco non annulla i blocchi già importati.",
+    )
+    job_id = fields.Many2one("tessera.import.job", string="Import", readonly=True)
+    job_state = fields.Selection(related="job_id.state", string="Stato import")
+    job_progresso = fields.Float(related="job_id.progresso", string="Avanzamento")
+    job_righe_elaborate = fields.Integer(related="job_id.righe_elaborate")
+    job_righe_totali = fields.Integer(related="job_id.righe_totali")
+    error_attachment_id = fields.Many2one(related="job_id.error_attachment_id")
+    stato_import = fields.Char(related="job_id.stato_import", string="Esito")
+    # Esito della verifica (dry-run) del file
+    verifica_eseguita = fields.Boolean(readonly=True)
+    verifica_righe = fields.Integer(string="Righe", readonly=True)
+    verifica_esistenti = fields.Integer(string="Associati esistenti", readonly=True)
+    verifica_nuovi = fields.Integer(string="Nuovi associati", readonly=True)
+    verifica_duplicati = fields.Integer(string="Duplicati nel file", readonly=True)
+    verifica_errori = fields.Integer(string="Righe in errore", readonly=True)
+    verifica_anteprima = fields.Html(string="Anteprima", readonly=True, sanitize=False)
 
-    def _find_or_create_associato(self, row, Associato):
-        email = self._normalize_email(row.get("email") or row.get("Email") or "")
-        cf = self._normalize_cf(row.get("codice_fiscale") or row.get("codice fiscale") or row.get("cf") or "")
-        nome = (row.get("nome_legale") or row.get("nome") or "").strip()
-        cognome = (row.get("cognome_legale") or row.get("cognome") or "").strip()
-        if email:
-            # Match esatto case-insensitive senza wildcard: LOWER(email)=LOWER(%s) evita che
-            # _ e % in ILIKE vengano interpretati come wildcard (email con underscore/percentuale sono valide RFC)
-            self.env.cr.execute(
-                "SELECT id FROM " + Associato._table + " WHERE LOWER(email) = LOWER(%s) LIMIT 1",
-                (email,),
-            )
-            row = self.env.cr.fetchone()
-            if row:
-                associato = Associato.browse(row[0])
-                if associato.exists():
-                    return associato, False
-        if cf:
-            associato = Associato.search([("codice_fiscale", "=", cf)], limit=1)
-            if associato:
-                return associato, False
-        if not email:
-            raise ValidationError(_("Riga senza email né associato esistente."))
-        vals = {"email": email, "nome_legale": nome or False, "cognome_legale": cognome or False}
-        if cf:
-            vals["codice_fiscale"] = cf
-        return Associato.create(vals), True
+    def _get_data_attachment(self):
+        """Allegato del campo data_file (il file caricato)."""
+        return self.env["ir.attachment"].sudo().search([
+            ("res_model", "=", self._name),
+            ("res_field", "=", "data_file"),
+            ("res_id", "=", self.id),
+        ], limit=1)
 
-    def _parse_date(self, value):
-        if not value or not str(value).strip():
-            return fields.Date.today()
-        s = str(value).strip()
-        for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
-            try:
-                return datetime.strptime(s, fmt).date()
-            except ValueError:
-                continue
-        return fields.Date.today()
+    def action_verifica(self):
+        """
+        Verifica il file senza importare nulla: conteggi di associati esistenti, nuovi,
+        duplicati nel file e righe in errore, con un'anteprima delle righe.
+        """
+        self.ensure_one()
+        attachment = self._get_data_attachment()
+        if not attachment:
+            raise UserError(_("Carica un file CSV."))
+        started = time.perf_counter()
+        with open_csv_attachment(attachment) as (header, rows):
+            counts, preview = self.env["tessera.import.job"]._dry_run(rows)
+        _logger.info(
+            "Verifica import tessere: %s righe in %.2fs", counts["righe"], time.perf_counter() - started
+        )
+        self.write({
+            "verifica_eseguita": True,
+            "verifica_righe": counts["righe"],
+            "verifica_esistenti": counts["esistenti"],
+            "verifica_nuovi": counts["nuovi"],
+            "verifica_duplicati": counts["duplicati"],
+            "verifica_errori": counts["errori"],
+            "verifica_anteprima": self.env["ir.qweb"]._render(
+                "associazioni_culturali.tessera_import_anteprima",
+                {"righe": preview, "totale": counts["righe"]},
+            ),
+        })
+        return self.action_aggiorna()
 
     def action_import(self):
+        """
+        Avvia l'import in background: il file viene salvato come allegato di un job elaborato
+        a blocchi dal cron, fuori dalla richiesta HTTP (niente limite di tempo della richiesta).
+        """
         self.ensure_one()
-        if not self.associazione_id or not self.piano_id or not self.data_file:
+        # L'allegato del campo data_file passa al job: nessuna copia del contenuto
+        attachment = self._get_data_attachment()
+        if not self.associazione_id or not self.piano_id or not attachment:
             raise UserError(_("Seleziona associazione, piano e carica un file CSV."))
-        try:
-            data = base64.b64decode(self.data_file)
-        except Exception as e:
-            raise UserError(_("File non valido: %s") % str(e))
-        try:
-            text = data.decode("utf-8-sig")
-        except UnicodeDecodeError:
-            text = data.decode("latin-1", errors="replace")
-        reader = csv.DictReader(io.StringIO(text), delimiter=";")
-        if not reader.fieldnames:
-            reader = csv.DictReader(io.StringIO(text), delimiter=",")
-        if not reader.fieldnames:
-            raise UserError(_("CSV senza intestazioni. Colonne: email, codice_fiscale, nome_legale, cognome_legale, data_emissione."))
-        Associato = self.env["associato"].sudo()
-        Tessera = self.env["tessera"].sudo()
-        created_associati = 0
-        created_tessere = 0
-        errors = []
-        for i, row in enumerate(reader, start=2):
-            if not any(v and str(v).strip() for v in (row or {}).values()):
-                continue
-            try:
-                associato, is_new = self._find_or_create_associato(row, Associato)
-                if is_new:
-                    created_associati += 1
-                data_emissione = self._parse_date(
-                    row.get("data_emissione") or row.get("data emissione") or row.get("Data emissione") or ""
-                )
-                Tessera.create({
-                    "associazione_id": self.associazione_id.id,
-                    "piano_id": self.piano_id.id,
-                    "associato_id": associato.id,
-                    "data_emissione": data_emissione,
-                    "invia_email_conferma": self.invia_email_conferma,
-                })
-                created_tessere += 1
-            except Exception as e:
-                errors.append("Riga %s: %s" % (i, str(e)))
-        if errors:
-            self.stato_import = _("Importate %s tessere, %s nuovi associati. Errori: ") % (created_tessere, created_associati) + "; ".join(errors[:15])
-        else:
-            self.stato_import = _("Importate %s tessere. Creati %s nuovi associati.") % (created_tessere, created_associati)
+        name = self.filename or _("import_tessere.csv")
+        job = self.env["tessera.import.job"].create({
+            "name": name,
+            "associazione_id": self.associazione_id.id,
+            "piano_id": self.piano_id.id,
+            "invia_email_conferma": self.invia_email_conferma,
+            "chunk_size": self.chunk_size,
+            "attachment_id": attachment.id,
+        })
+        attachment.write({
+            "name": name,
+            "mimetype": "text/csv",
+            "res_model": job._name,
+            "res_field": False,
+            "res_id": job.id,
+        })
+        self.job_id = job
+        self.env.ref("associazioni_culturali.ir_cron_tessera_import_job")._trigger()
+        return self.action_aggiorna()
+
+    def action_aggiorna(self):
+        """
+        Riapre il wizard con l'avanzamento aggiornato del job. La barra di avanzamento si
+        aggiorna già da sola mentre il job è in corso (widget tessera_import_progressbar).
+        """
+        self.ensure_one()
         return {
             "type": "ir.actions.act_window",
             "res_model": "tessera.import.wizard",
@@ -139,3 +136,7 @@ class TesseraImportWizard(models.TransientModel):
             "view_mode": "form",
             "target": "new",
         }
+
+    def action_download_errori(self):
+        self.ensure_one()
+        return self.job_id.action_download_errori()